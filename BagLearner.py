@@ -1,7 +1,28 @@
+import json
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
 import numpy as np
 
+from RTLearner import RTLearner, bin_features
+from instrument import timed, rows_of_arg
+
+# Saved model format: magic, version and header length, a json header, then the node arrays of all trees back to back
+MODEL_MAGIC = b"BAGMODEL"
+MODEL_VERSION = 1
+MODEL_ALIGN = 64
+MODEL_ARRAYS = (("features", np.int32), ("split_vals", np.float64), ("left", np.int32), ("right", np.int32))
+
+
 class BagLearner(object):
-    def __init__(self, learner=None, kwargs=None, bags=10, boost=False, verbose=False):
+    def __init__(self, learner=None, kwargs=None, bags=10, boost=False, verbose=False, n_jobs=None, executor="process"):
+        """
+        :param n_jobs: Number of workers to train and query the bags with, None trains them serially
+        :param executor: "process" (shared memory inputs, falls back to threads if processes are unavailable) or "thread"
+        """
         if not kwargs:
             kwargs = {}
         self.learners = [learner(**kwargs) for _ in range(0, bags)]
@@ -9,26 +30,195 @@ class BagLearner(object):
         self.boost = boost
         self.verbose = verbose
         self.kwargs = kwargs
+        self.n_jobs = n_jobs
+        self.executor = executor
 
     def author(self):
         return 'narora62'
 
+    @timed("BagLearner.add_evidence", rows=rows_of_arg("Xdata"))
     def add_evidence(self, Xdata, Ydata):
-        data = np.concatenate((Xdata, Ydata[:, None]), axis=1)
-        np.random.shuffle(data)
+        # Learners with bins share one quantization of the data, bags are drawn from the uint8 codes
+        bins = self.kwargs.get('bins')
+        if bins:
+            codes, edges = bin_features(Xdata, bins)
+
+        if self.n_jobs:
+            # Per bag seeds come from the global RNG, so np.random.seed makes parallel runs reproducible
+            seeds = np.random.randint(np.iinfo(np.int32).max, size=self.bags)
+            arrays = (codes, Ydata, edges) if bins else (Xdata, Ydata)
+            self.learners = self._run_parallel(_train_bag, list(zip(self.learners, seeds)), arrays)
+            return
+
+        # Only the draws of the shuffle matter (they keep seeded bags unchanged), so no copy of the data is shuffled
+        np.random.shuffle(np.arange(len(Xdata)))
 
         for learner in self.learners:
             idx = np.random.choice(Xdata.shape[0], Ydata.shape[0])
-            learner.add_evidence(Xdata[idx], Ydata[idx])
+            if bins:
+                learner.add_binned_evidence(codes[idx], Ydata[idx], edges)
+            else:
+                learner.add_evidence(Xdata[idx], Ydata[idx])
 
             if self.verbose:
-                print(f"BagLearner: Learner {self.learners[idx]} built successfully")
+                print(f"BagLearner: Learner {learner} built successfully")
 
+    @timed("BagLearner.query", rows=rows_of_arg("points"))
     def query(self, points):
+        if self.n_jobs:
+            output_query_list = self._run_parallel(_query_bag, self.learners, (points,))
+            return np.mean(output_query_list, axis=0)
+
         output_query_list = []
         for learner in self.learners:
             output_query_list.append(learner.query(points))
             if self.verbose:
                 print(f"BagLearner: Learner {learner} built successfully")
 
-        return np.mean(output_query_list, axis=0)
\ No newline at end of file
+        return np.mean(output_query_list, axis=0)
+
+    def save(self, path, metadata=None):
+        """
+        Save the trained trees in the versioned binary model format, see load
+        Every array section starts on a MODEL_ALIGN byte boundary so it can be memory mapped
+        :param metadata: json serializable dict kept in the header (e.g. the StrategyLearner parameters)
+        """
+        if not all(isinstance(learner, RTLearner) for learner in self.learners):
+            raise TypeError("BagLearner: only RTLearner bags can be saved")
+
+        node_counts = [len(learner.features) for learner in self.learners]
+        if not all(node_counts):
+            raise ValueError("BagLearner: only trained bags can be saved")
+        header = {'learner': 'RTLearner', 'kwargs': self.kwargs, 'bags': self.bags, 'boost': self.boost,
+                  'node_counts': node_counts, 'arrays': {}, 'metadata': metadata or {}}
+
+        # Array offsets are relative to the data start, the first aligned byte after the header
+        offset = 0
+        for name, dtype in MODEL_ARRAYS:
+            header['arrays'][name] = [np.dtype(dtype).str, offset]
+            offset += _align_up(sum(node_counts) * np.dtype(dtype).itemsize)
+        header_bytes = json.dumps(header).encode()
+        data_start = _align_up(len(MODEL_MAGIC) + 8 + len(header_bytes))
+
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(MODEL_MAGIC + struct.pack("<II", MODEL_VERSION, len(header_bytes)) + header_bytes)
+            for name, dtype in MODEL_ARRAYS:
+                f.write(b"\0" * (data_start + header['arrays'][name][1] - f.tell()))
+                for learner in self.learners:
+                    f.write(np.ascontiguousarray(getattr(learner, name), dtype=dtype).tobytes())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, verbose=False):
+        """
+        Load a model written by save, the node arrays of every tree are read only views of one memory map
+        Nothing is unpickled, and processes loading the same file share its pages
+        :return: (BagLearner, metadata)
+        """
+        with open(path, "rb") as f:
+            magic = f.read(len(MODEL_MAGIC))
+            if magic != MODEL_MAGIC:
+                raise ValueError(f"BagLearner: {path} is not a saved model")
+            version, header_len = struct.unpack("<II", f.read(8))
+            if version != MODEL_VERSION:
+                raise ValueError(f"BagLearner: unsupported model version {version}, expected {MODEL_VERSION}")
+            header = json.loads(f.read(header_len))
+        data_start = _align_up(len(MODEL_MAGIC) + 8 + header_len)
+
+        bag = cls(learner=RTLearner, kwargs=header['kwargs'], bags=header['bags'], boost=header['boost'], verbose=verbose)
+        bounds = np.cumsum([0] + header['node_counts'])
+        for name, (dtype, offset) in header['arrays'].items():
+            nodes = np.memmap(path, dtype=np.dtype(dtype), mode="r", offset=data_start + offset, shape=(int(bounds[-1]),))
+            for learner, lo, hi in zip(bag.learners, bounds[:-1], bounds[1:]):
+                setattr(learner, name, nodes[lo:hi])
+        return bag, header['metadata']
+
+    def _run_parallel(self, func, bags, arrays):
+        if self.executor == "process":
+            try:
+                return _run_in_processes(func, bags, arrays, self.n_jobs)
+            except (OSError, NotImplementedError, BrokenProcessPool) as e:
+                if self.verbose:
+                    print(f"BagLearner: Process pool unavailable ({e}), falling back to threads")
+
+        # Threads see the arrays directly, nothing to share, lists are converted like the process path does
+        arrays = tuple(np.asarray(array) for array in arrays)
+        with ThreadPoolExecutor(max_workers=self.n_jobs) as pool:
+            return list(pool.map(func, bags, [arrays] * len(bags)))
+
+
+def _align_up(size):
+    return -(-size // MODEL_ALIGN) * MODEL_ALIGN
+
+
+def _run_in_processes(func, bags, arrays, n_jobs):
+    # Copy every input array once into shared memory, workers only receive the block names
+    blocks = []
+    try:
+        specs = []
+        for array in arrays:
+            array = np.ascontiguousarray(array)
+            shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            blocks.append(shm)
+            np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+            specs.append((shm.name, array.shape, array.dtype.str))
+
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            return list(pool.map(func, bags, [tuple(specs)] * len(bags)))
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+
+def _attach(specs):
+    # Arrays passed by a thread pool are used as is, shared memory specs are mapped without a copy
+    blocks, arrays = [], []
+    for spec in specs:
+        if isinstance(spec, np.ndarray):
+            arrays.append(spec)
+            continue
+        name, shape, dtype = spec
+        shm = shared_memory.SharedMemory(name=name)
+        blocks.append(shm)
+        arrays.append(np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    return arrays, blocks
+
+
+def _detach(blocks):
+    for shm in blocks:
+        shm.close()
+
+
+def _train_bag(bag, specs):
+    learner, seed = bag
+    rng = np.random.RandomState(seed)
+
+    arrays, blocks = _attach(specs)
+    Xdata, Ydata = arrays[:2]
+    idx = rng.choice(Xdata.shape[0], Ydata.shape[0])
+    bag_x, bag_y = Xdata[idx], Ydata[idx]
+    # Binned data comes with its bin edges
+    edges = np.array(arrays[2]) if len(arrays) == 3 else None
+    del arrays, Xdata, Ydata
+    _detach(blocks)
+
+    # The bag seed only drives this fit, in thread mode the learner is the one kept in self.learners
+    previous, learner.seed = learner.seed, rng.randint(np.iinfo(np.int32).max)
+    try:
+        if edges is None:
+            learner.add_evidence(bag_x, bag_y)
+        else:
+            learner.add_binned_evidence(bag_x, bag_y, edges)
+    finally:
+        learner.seed = previous
+    return learner
+
+
+def _query_bag(learner, specs):
+    arrays, blocks = _attach(specs)
+    Y_out = np.array(learner.query(arrays[0]))
+    del arrays
+    _detach(blocks)
+    return Y_out
@@ -1,10 +1,9 @@
 import datetime as dt
 import pandas as pd
-from matplotlib import pyplot as plt
 
-from indicators import calculate_williamsR, calculate_RSI_EMV, calculate_momentum
-from marketsimcode import compute_portvals, compute_optimized_portfolio_stats
-from util import get_data
+from indicators import batch_indicators
+from marketsimcode import compute_portvals, compute_optimized_portfolio_stats, signals_to_trades
+from util import get_data, get_pyplot
 
 
 def testPolicy(symbol="AAPL", sd='2010-01-01', ed='2011-12-31', sv=100000):
@@ -16,76 +15,45 @@ def testPolicy(symbol="AAPL", sd='2010-01-01', ed='2011-12-31', sv=100000):
     port_val.fillna(method='ffill', inplace=True)
     port_val.fillna(method='bfill', inplace=True)
 
-    net_shares = 0
-
     # Get all indicators port_vals
-    williamsR = calculate_williamsR(port_val.copy(), window=4, plot=False, ret_val=True, symbol=symbol)[['williams']]
-    rsi = calculate_RSI_EMV(port_val.copy(), window=4, plot=False, ret_val=True, symbol=symbol)[['RSI_EMV']]
-    momentum = calculate_momentum(port_val.copy(), window=8, plot=False, ret_val=True, symbol=symbol)[['momentum']]
+    indicators = batch_indicators(port_val, {'williamsR': 4, 'rsi': 4, 'momentum': 8})
 
-    port_val['williamsR'] = williamsR
-    port_val['rsi'] = rsi
-    port_val['momentum'] = momentum
+    port_val['williamsR'] = indicators['williamsR'][symbol]
+    port_val['rsi'] = indicators['rsi'][symbol]
+    port_val['momentum'] = indicators['momentum'][symbol]
 
     port_val.fillna(method='ffill', inplace=True)
     port_val.fillna(method='bfill', inplace=True)
 
-    for date, _ in port_val.iterrows():
-        momentum = port_val.loc[date, 'momentum']
-        williamsR = port_val.loc[date, 'williamsR']
-
-        rsi_index_today = port_val.loc[date, 'rsi']
-        rsi_index_yesterday = port_val[['rsi']].shift(1).fillna(0).loc[date][0]
-
-        rsi_upper_band = 0.7 * port_val['rsi'].max()
-        rsi_lower_band = 0.3 * port_val['rsi'].max()
-
-        # rsi today is less than 30 %
-        if rsi_index_today < rsi_lower_band:
-            if rsi_index_yesterday <= rsi_lower_band:
-                port_val.loc[date, 'shares'] = None
-            elif rsi_index_yesterday > rsi_lower_band or williamsR < -60 or momentum < -0.25:  # BUY
-                if net_shares == 0:
-                    port_val.loc[date, 'shares'] = 1000
-                    net_shares += 1000
-                elif net_shares == -1000:
-                    port_val.loc[date, 'shares'] = 2000
-                    net_shares += 2000
-
-        # rsi today is between 30% and 70%
-        elif rsi_lower_band < rsi_index_today < rsi_upper_band:
-            if rsi_index_yesterday < rsi_lower_band or williamsR < -60 or momentum < -0.25:
-                if net_shares == 0:
-                    port_val.loc[date, 'shares'] = 1000
-                    net_shares += 1000
-                elif net_shares == -1000:
-                    port_val.loc[date, 'shares'] = 2000
-                    net_shares += 2000
-            elif rsi_lower_band < rsi_index_yesterday < rsi_upper_band:
-                port_val.loc[date, 'shares'] = None
-            elif rsi_index_yesterday > 70 or williamsR > -50:
-                if net_shares == 0:
-                    port_val.loc[date, 'shares'] = -1000
-                    net_shares -= 1000
-                elif net_shares == 1000:
-                    port_val.loc[date, 'shares'] = -2000
-                    net_shares -= 2000
-
-        # rsi today is greater than 70%
-        elif rsi_index_today > rsi_upper_band:
-            if rsi_index_yesterday >= rsi_upper_band:
-                port_val.loc[date, 'shares'] = None
-            elif rsi_index_yesterday < rsi_upper_band or williamsR > -50:  # SELL
-                if net_shares == 0:
-                    port_val.loc[date, 'shares'] = -1000
-                    net_shares -= 1000
-                elif net_shares == 1000:
-                    port_val.loc[date, 'shares'] = -2000
-                    net_shares -= 2000
-
-        # Something else is going on here
-        else:
-            print(f"Wrong rsi_index_today: {rsi_index_today}")
+    momentum = port_val['momentum'].to_numpy()
+    williamsR = port_val['williamsR'].to_numpy()
+
+    rsi_index_today = port_val['rsi'].to_numpy()
+    rsi_index_yesterday = port_val['rsi'].shift(1).fillna(0).to_numpy()
+
+    rsi_upper_band = 0.7 * port_val['rsi'].max()
+    rsi_lower_band = 0.3 * port_val['rsi'].max()
+
+    # rsi today is less than 30 %, between 30% and 70%, greater than 70%
+    rsi_below = rsi_index_today < rsi_lower_band
+    rsi_between = (rsi_lower_band < rsi_index_today) & (rsi_index_today < rsi_upper_band)
+    rsi_above = rsi_index_today > rsi_upper_band
+
+    # BUY when rsi crosses below the lower band, or between the bands on an oversold signal
+    buy_between = rsi_between & ((rsi_index_yesterday < rsi_lower_band) | (williamsR < -60) | (momentum < -0.25))
+    buy = (rsi_below & (rsi_index_yesterday > rsi_lower_band)) | buy_between
+
+    # SELL when rsi crosses above the upper band, or between the bands (and not already between) on an overbought signal
+    yesterday_between = (rsi_lower_band < rsi_index_yesterday) & (rsi_index_yesterday < rsi_upper_band)
+    sell_between = rsi_between & ~buy_between & ~yesterday_between & ((rsi_index_yesterday > 70) | (williamsR > -50))
+    sell = (rsi_above & (rsi_index_yesterday < rsi_upper_band)) | sell_between
+
+    # Something else is going on here
+    for rsi_today in rsi_index_today[~(rsi_below | rsi_between | rsi_above)]:
+        print(f"Wrong rsi_index_today: {rsi_today}")
+
+    trades, net_shares = signals_to_trades(buy, sell)
+    port_val['shares'] = trades
 
     if net_shares != 0:
         if net_shares < 0:
@@ -107,6 +75,7 @@ def author():
 
 def plt_data(port_vals_bchm_norm, port_vals_norm, plot=False):
     if plot:
+        plt = get_pyplot()
         new_pd = pd.concat([port_vals_bchm_norm, port_vals_norm], axis=1)
         ax = new_pd.plot(title="Normalized Benchmark with Theoretically Optimum Strategy", fontsize=12, color=["green", "red"])
         ax.set_xlabel("Date")
@@ -117,10 +86,10 @@ def plt_data(port_vals_bchm_norm, port_vals_norm, plot=False):
 
 
 def run_manual_strategy(df_trades, symbols, start_date, end_date, save_fig=False, fig_name='Manual-Strategy.png'):
-    port_val_ms = compute_portvals(orders=df_trades, start_val=100000, commission=9.95, impact=0.00)
+    port_val_ms = compute_portvals(orders=df_trades, start_val=100000, commission=9.95, impact=0.00, symbol=symbols)
 
     portval_bench = bench_mark(symbols, start_date, end_date, 100000)
-    port_val_bench = compute_portvals(orders=portval_bench, start_val=100000, commission=0.00, impact=0.00)
+    port_val_bench = compute_portvals(orders=portval_bench, start_val=100000, commission=0.00, impact=0.00, symbol=symbols)
 
     cum_ret, avg_daily_ret, std_daily_ret, sharpe_ratio = compute_optimized_portfolio_stats(port_val_ms['portval'])
     cum_ret_bchm, avg_daily_ret_bchm, std_daily_ret_bchm, sharpe_ratio_bchm = compute_optimized_portfolio_stats(port_val_bench['portval'])
@@ -143,6 +112,7 @@ def run_manual_strategy(df_trades, symbols, start_date, end_date, save_fig=False
     port_val_bench.rename(columns={'portval': 'Benchmark'}, inplace=True)
     port_val_ms.rename(columns={'portval': 'Manual Strategy'}, inplace=True)
 
+    plt = get_pyplot()
     colors = {'Benchmark': 'green', 'Manual Strategy': 'red'}
     ax = pd.concat([port_val_bench, port_val_ms], axis=1).plot(title="Normalized Benchmark with Manual Strategy", fontsize=12, color=['green', 'red'])
     ax.set_xlabel("Date")
@@ -164,10 +134,10 @@ if __name__ == '__main__':
     symbols = 'JPM'
 
     portval_ms = testPolicy(symbols, start_date, end_date, 100000)
-    port_val_ms = compute_portvals(orders=portval_ms, start_val=100000, commission=9.95, impact=0.00)
+    port_val_ms = compute_portvals(orders=portval_ms, start_val=100000, commission=9.95, impact=0.00, symbol=symbols)
 
     portval_bench = bench_mark(symbols, start_date, end_date, 100000)
-    port_val_bench = compute_portvals(orders=portval_bench, start_val=100000, commission=0.00, impact=0.00)
+    port_val_bench = compute_portvals(orders=portval_bench, start_val=100000, commission=0.00, impact=0.00, symbol=symbols)
 
     cum_ret, avg_daily_ret, std_daily_ret, sharpe_ratio = compute_optimized_portfolio_stats(port_val_ms['portval'])
     cum_ret_bchm, avg_daily_ret_bchm, std_daily_ret_bchm, sharpe_ratio_bchm = compute_optimized_portfolio_stats(port_val_bench['portval'])
@@ -190,6 +160,7 @@ if __name__ == '__main__':
     port_val_bench.rename(columns={'portval': 'Benchmark'}, inplace=True)
     port_val_ms.rename(columns={'portval': 'Manual Strategy'}, inplace=True)
 
+    plt = get_pyplot()
     colors = {'Benchmark': 'green', 'Manual Strategy': 'red'}
     ax = pd.concat([port_val_bench, port_val_ms], axis=1).plot(title="Normalized Benchmark with Manual Strategy (Out-Sample)", fontsize=12, color=colors)
     ax.set_xlabel("Date")
@@ -1,17 +1,55 @@
 import numpy as np
 
+from instrument import timed, rows_of_arg
+
+# Feature index marking a leaf node, its split value holds the leaf prediction
+LEAF = -1
+
+
+def bin_features(xdata, bins=256):
+    """
+    Quantize every feature column into at most bins uint8 bins of about equal counts
+    Bin b of a feature holds the values in (edges[b - 1], edges[b]], the edges are values of the column
+    :return: codes (rows x features, uint8), edges (features x bins, float64, padded with inf)
+    """
+    if not 1 < bins <= 256:
+        raise ValueError(f"RTLearner: bins must be between 2 and 256, got {bins}")
+    xdata = np.asarray(xdata, dtype=np.float64)
+    codes = np.empty(xdata.shape, dtype=np.uint8)
+    edges = np.full((xdata.shape[1], bins), np.inf)
+    positions = np.maximum(np.arange(1, bins + 1) * len(xdata) // bins - 1, 0)
+    for feature in range(xdata.shape[1]):
+        column = xdata[:, feature]
+        feature_edges = np.unique(np.sort(column)[positions]) if len(column) else np.empty(0)
+        edges[feature, :len(feature_edges)] = feature_edges
+        codes[:, feature] = np.searchsorted(feature_edges, column)
+    return codes, edges
+
+
 class RTLearner(object):
-    def __init__(self, leaf_size=1, verbose=False):
+    def __init__(self, leaf_size=1, verbose=False, seed=None, bins=None):
         """
-        Node -> [split_label_index, node_val, left_tree_row_idx, right_tree_row_idx ]
-        The left tree is the next row, so left_tree_row_idx is node_row_idx + 1
+        Node i -> [features[i], split_vals[i], left[i], right[i]]
+        The model is stored as flat typed arrays (struct of arrays), one entry per node:
+            features   -> int32 split feature index, LEAF for a leaf node
+            split_vals -> float64 split value, or the leaf value for a leaf node
+            left/right -> int32 offsets from the node row to its left/right child rows
+        The left tree is the next row, so left[i] is 1 for every split node
         Tree generation is Depth first
         :param leaf_size:
         :param verbose:
+        :param seed: Seed of a private RandomState for the split features, None uses the global np.random
+        :param bins: Quantize every feature into at most bins (<= 256) uint8 bins before training (see bin_features),
+            nodes then split at the bin holding the median instead of the exact median. None trains on the raw data
         """
         self.leaf_size = leaf_size
         self.verbose = verbose
-        self.model = list()
+        self.seed = seed
+        self.bins = bins
+        self.features = np.empty(0, dtype=np.int32)
+        self.split_vals = np.empty(0, dtype=np.float64)
+        self.left = np.empty(0, dtype=np.int32)
+        self.right = np.empty(0, dtype=np.int32)
 
     def author(self):
         return "narora62"
@@ -20,64 +58,152 @@ class RTLearner(object):
         """
         :return:
         """
-        concat_data = np.concatenate((xdata, ydata[:, None]), axis=1)
-        self.model = self.build_tree(concat_data)
-        if self.verbose:
-            print(f"RTLearner: Verbose True: {self.model}")
-
-    def build_tree(self, data):
-        data_rows_len = data.shape[0]
-        x = data[:, :-1]
-        y = data[:, -1]
-
-        # Terminal statement to break recursive callbacks
-        if data_rows_len <= self.leaf_size or np.all(y == y[0]):
-            # Return the leaf node
-            return np.array([["Leaf", np.mean(y), None, None]])
-
-        # Random index
-        feature_index = np.random.randint(data.shape[1]-1)
-
-        # Data Column
-        data_column = data[:, feature_index]
-
-        # Root node -> median
-        splitVal = np.median(data_column)
-
-        if np.array_equal(data[data[:, feature_index] <= splitVal], data):
-            return np.array([["Leaf", np.mean(data[:, -1]), "NA", "NA"]], dtype=object)
-
-
-        # Callback recursive until leaf
+        if self.bins:
+            codes, edges = bin_features(xdata, self.bins)
+            self.add_binned_evidence(codes, ydata, edges)
+            return
 
-        # Left tree -> < median
-        left_tree = self.build_tree(data[data_column <= splitVal])
-
-        # Right tree -> > median
-        right_tree = self.build_tree(data[data_column > splitVal])
-
-        root = np.array([[feature_index, splitVal, 1, left_tree.shape[0] + 1]])
+        self.features, self.split_vals, self.left, self.right = self.build_tree(xdata, ydata)
+        if self.verbose:
+            print(f"RTLearner: Verbose True: {self.features}, {self.split_vals}, {self.left}, {self.right}")
 
-        return np.concatenate((root, left_tree, right_tree), axis=0)
+    def add_binned_evidence(self, codes, ydata, edges):
+        """
+        Train on features already quantized by bin_features, e.g. once for all the bags of a BagLearner
+        :param codes: uint8 bin codes (rows x features)
+        :param edges: bin upper edges (features x bins)
+        """
+        self.features, self.split_vals, self.left, self.right = self.build_tree(codes, ydata, edges)
+        if self.verbose:
+            print(f"RTLearner: Verbose True: {self.features}, {self.split_vals}, {self.left}, {self.right}")
 
+    @timed("RTLearner.build_tree", rows=rows_of_arg("xdata"))
+    def build_tree(self, xdata, ydata, edges=None):
+        """
+        Iterative depth first builder over one index array
+        Each stack entry owns the rows idx[lo:hi], a split partitions that slice in place
+        (left rows first, order preserved) so no data matrix is ever copied
+        Nodes are numbered in the same pre-order as the recursive builder, which also keeps
+        the sequence of np.random draws (and so the trees) unchanged
+        With edges, xdata holds bin codes: the split bin is found from the bin counts of the node and the
+        split value is the upper edge of that bin, so query works on raw data either way
+        :param xdata:
+        :param ydata:
+        :param edges: Bin upper edges (features x bins) when xdata holds bin codes
+        :return: features, split_vals, left, right
+        """
+        data_rows_len, n_features = xdata.shape
+        if edges is not None:
+            # One contiguous code column per feature, the nodes gather from it
+            xdata = np.ascontiguousarray(xdata.T)
+        rng = np.random if self.seed is None else np.random.RandomState(self.seed)
+
+        # A tree with at least one row per leaf never has more than 2n - 1 nodes
+        max_nodes = max(2 * data_rows_len - 1, 1)
+        features = np.full(max_nodes, LEAF, dtype=np.int32)
+        split_vals = np.zeros(max_nodes, dtype=np.float64)
+        left = np.zeros(max_nodes, dtype=np.int32)
+        right = np.zeros(max_nodes, dtype=np.int32)
+
+        idx = np.arange(data_rows_len)
+
+        # Stack entry -> (lo, hi, parent node if this is a right subtree else -1)
+        stack = [(0, data_rows_len, -1)]
+        n_nodes = 0
+        while stack:
+            lo, hi, parent = stack.pop()
+            node = n_nodes
+            n_nodes += 1
+            if parent >= 0:
+                right[parent] = node - parent
+
+            # Single row leaf, skip the array reductions
+            if hi - lo == 1:
+                split_vals[node] = ydata[idx[lo]]
+                continue
+
+            rows = idx[lo:hi]
+            y = ydata[rows]
+
+            # Leaf node
+            if hi - lo <= self.leaf_size or np.all(y == y[0]):
+                split_vals[node] = np.mean(y)
+                continue
+
+            # Random index
+            feature_index = rng.randint(n_features)
+
+            if edges is None:
+                # Data Column
+                data_column = xdata[rows, feature_index]
+
+                # Root node -> median
+                splitVal = np.median(data_column)
+                go_left = data_column <= splitVal
+            else:
+                # Bin holding the median, from the cumulative bin counts of the node
+                data_column = xdata[feature_index, rows]
+                cum_counts = np.cumsum(np.bincount(data_column))
+                split_bin = np.searchsorted(cum_counts, (hi - lo + 1) // 2)
+                splitVal = edges[feature_index, split_bin]
+                go_left = data_column <= split_bin
+
+            n_left = np.count_nonzero(go_left)
+            if n_left == hi - lo:
+                split_vals[node] = np.mean(y)
+                continue
+
+            # Left tree -> <= median, Right tree -> > median
+            left_rows = rows[go_left]
+            right_rows = rows[~go_left]
+            idx[lo:lo + n_left] = left_rows
+            idx[lo + n_left:hi] = right_rows
+
+            features[node] = feature_index
+            split_vals[node] = splitVal
+            left[node] = 1
+
+            # Right pushed first so the left subtree is built (and numbered) first
+            stack.append((lo + n_left, hi, node))
+            stack.append((lo, lo + n_left, -1))
+
+        return features[:n_nodes], split_vals[:n_nodes], left[:n_nodes], right[:n_nodes]
+
+    @timed("RTLearner.query", rows=rows_of_arg("points"))
     def query(self, points):
-        Y_out = []
-        for data_row in points:
-            row = 0
-            while True:
-                # Idx of feature to split
-                feature_index = self.model[row][0]
-
-                if feature_index == "Leaf":
-                    Y_out.append(self.model[row][1])
+        """
+        Batched traversal: all rows move down the tree one level at a time
+        Rows that reached a leaf drop out of the active set
+        :param points:
+        :return:
+        """
+        points = np.ascontiguousarray(points, dtype=np.float64)
+        n_points, n_features = points.shape
+        flat_points = points.reshape(-1)
+
+        # Absolute child rows of every node, column 0 the right child and column 1 the left one,
+        # so the comparison result indexes the next node directly
+        nodes = np.arange(len(self.features))
+        children = np.stack((nodes + self.right, nodes + self.left), axis=1)
+
+        # Only the rows still inside the tree are kept, each with its current node
+        Y_out = np.empty(n_points)
+        rows = np.arange(n_points)
+        current = np.zeros(n_points, dtype=np.intp)
+        feature = np.full(n_points, self.features[0], dtype=np.intp)
+        while rows.size:
+            at_leaf = feature == LEAF
+            if at_leaf.any():
+                Y_out[rows[at_leaf]] = self.split_vals[current[at_leaf]]
+                inside = ~at_leaf
+                rows, current, feature = rows[inside], current[inside], feature[inside]
+                if not rows.size:
                     break
-                else:
-                    if data_row[int(feature_index)] <= self.model[row][1]:
-                        row += int(self.model[row][2])
-                    elif data_row[int(feature_index)] > self.model[row][1]:
-                        row += int(self.model[row][3])
+            go_left = flat_points[rows * n_features + feature] <= self.split_vals[current]
+            current = children[current, go_left.view(np.uint8)]
+            feature = self.features[current]
 
         if self.verbose:
             print(f"RTLearner: Output: {Y_out}")
 
-        return np.array(Y_out)
\ No newline at end of file
+        return Y_out
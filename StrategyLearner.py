@@ -1,40 +1,58 @@
 import datetime as dt
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 import pandas as pd
-from matplotlib import pyplot as plt
 
 import util as ut
 from BagLearner import BagLearner
 from RTLearner import RTLearner
-from indicators import calculate_momentum, calculate_RSI_EMV, calculate_williamsR
-from marketsimcode import compute_portvals, compute_optimized_portfolio_stats
+from indicators import batch_indicators, cached_indicators
+from instrument import timed, add_rows, rows_of_result
+from marketsimcode import compute_portvals, compute_optimized_portfolio_stats, signals_to_trades
+
+# Indicator -> window of the learner features
+INDICATOR_WINDOWS = {'rsi': 4, 'williamsR': 14, 'momentum': 14}
+# Forward return horizon of the training labels
+LABEL_WINDOW = 15
 
 
 class StrategyLearner(object):
 
-    def __init__(self, verbose=False, impact=0.0, commission=0.0, learner=BagLearner, leaf_size=5):
+    def __init__(self, verbose=False, impact=0.0, commission=0.0, learner=BagLearner, leaf_size=5, feature_cache=False, bags=15, bins=None):
+        """
+        :param feature_cache: Keep computed indicators in the on disk feature cache (indicators.cached_indicators),
+            off by default as the cache writes files under data/features
+        :param bins: Train the trees on features quantized into this many uint8 bins (RTLearner bins), None trains on the raw features
+        """
         self.verbose = verbose
         self.impact = impact
         self.commission = commission
         self.leaf_size = leaf_size
-        self.learner = learner(learner=RTLearner, kwargs={'leaf_size': self.leaf_size}, bags=15, boost=False, verbose=self.verbose)
+        self.feature_cache = feature_cache
+        self.bags = bags
+        self.learner_class = learner
+        self.bins = bins
+        kwargs = {'leaf_size': self.leaf_size} if bins is None else {'leaf_size': self.leaf_size, 'bins': bins}
+        self.learner = learner(learner=RTLearner, kwargs=kwargs, bags=bags, boost=False, verbose=self.verbose)
         self.train_x = None
         self.train_y = None
+        self.symbol_learners = None
 
     def discretize(self, df, symbol, window=5):
-        prices = df[symbol]
-        df['ratio'] = pd.Series(0, index=df.index)
-        df['train_y'] = pd.Series(0, index=df.index)
-        for i in range(prices.shape[0] - window):
-            ratio = (prices[i + window] / prices[i]) - 1
-            df['ratio'].iloc[i] = ratio
-            if ratio > self.impact * 10:
-                df['train_y'].iloc[i] = 1
-            elif ratio < -1 * (self.impact * 20):
-                df['train_y'].iloc[i] = -1
-            else:
-                df['train_y'].iloc[i] = 0
+        """
+        Label every day by its forward return over window days (1: BUY, -1: SELL, 0: HOLD)
+        The last window days have no forward price and are labelled 0
+        window can also be a list of horizons, the result then has one row of labels per horizon
+        """
+        ratio, train_y = label_forward_returns(df[symbol].to_numpy(), window, buy_threshold=self.impact * 10, sell_threshold=-1 * (self.impact * 20))
+        if not np.isscalar(window):
+            return train_y
 
         if self.verbose:
+            # Only the plot needs the ratio and labels as columns, the caller's frame is left untouched
+            df = df.assign(ratio=ratio, train_y=train_y)
+            plt = ut.get_pyplot()
             plt.rcParams['axes.grid'] = True
             plt.subplot(3, 1, 1)
             ax = df[symbol].plot(title=f'Stock Price ({symbol})', fontsize=8)
@@ -50,36 +68,47 @@ class StrategyLearner(object):
             ax.set_xlabel("Date")
             plt.show()
 
-        return df['train_y'].to_numpy()
+        return train_y
 
-    def add_evidence(self, symbol="JPM", sd=dt.datetime(2008, 1, 1), ed=dt.datetime(2009, 1, 1), sv=100000):
-        syms = [symbol]
+    def load_features(self, symbol="JPM", sd=dt.datetime(2008, 1, 1), ed=dt.datetime(2009, 1, 1)):
+        """
+        Prices of symbol with the indicator columns, the input of add_evidence and testPolicy
+        Sweeps load them once and pass them in as features
+        """
         dates = pd.date_range(sd, ed)
-        prices_all = ut.get_data(syms, dates, addSPY=False)  # automatically adds SPY
+        prices_all = ut.get_data([symbol], dates, addSPY=False)  # automatically adds SPY
         prices_all.dropna(inplace=True)
 
-        prices_all = self.compute_indicators(prices_all)
+        return self.compute_indicators(prices_all)
+
+    @timed("StrategyLearner.add_evidence", rows=rows_of_result)
+    def add_evidence(self, symbol="JPM", sd=dt.datetime(2008, 1, 1), ed=dt.datetime(2009, 1, 1), sv=100000, features=None):
+        if features is None:
+            prices_all = self.load_features(symbol, sd, ed)
+        else:
+            prices_all = features.copy()
 
-        prices_all_no_0 = prices_all.dropna(0)
+        prices_all_no_0 = prices_all.dropna()
         self.train_x = prices_all_no_0[['rsi', 'momentum', 'williamsR']].to_numpy()
-        self.train_y = self.discretize(df=prices_all_no_0, symbol=symbol, window=15)
+        self.train_y = self.discretize(df=prices_all_no_0, symbol=symbol, window=LABEL_WINDOW)
 
         self.learner.add_evidence(self.train_x, self.train_y)
 
         return prices_all
 
-    def testPolicy(self, symbol="JPM", sd=dt.datetime(2009, 1, 1), ed=dt.datetime(2010, 1, 1), sv=100000):
-
-        dates = pd.date_range(sd, ed)
-        prices_all = ut.get_data([symbol], dates, addSPY=False)  # automatically adds SPY
+    @timed("StrategyLearner.testPolicy")
+    def testPolicy(self, symbol="JPM", sd=dt.datetime(2009, 1, 1), ed=dt.datetime(2010, 1, 1), sv=100000, features=None):
+        if features is None:
+            prices_all = self.load_features(symbol, sd, ed)
+        else:
+            prices_all = features.copy()
         prices_all.dropna(inplace=True)
+        add_rows("StrategyLearner.testPolicy", len(prices_all))
 
-        prices_all = self.compute_indicators(prices_all)
-        prices_all.dropna(0, inplace=True)
-
-        prices_all['Y_out'] = self.learner.query(prices_all[['rsi', 'momentum', 'williamsR']].to_numpy())
+        prices_all['Y_out'] = self.predict(prices_all)
 
         if self.verbose:
+            plt = ut.get_pyplot()
             plt.rcParams['axes.grid'] = True
             plt.subplot(2, 1, 1)
             ax = prices_all[symbol].plot(title=f'Stock Price ({symbol})', fontsize=8)
@@ -97,29 +126,16 @@ class StrategyLearner(object):
             plt.show()
             plt.close()
 
-        net_shares = 0
-        for date, _ in prices_all.iterrows():
-            position = prices_all[["Y_out"]].loc[date][0]
-
-            # BUY
-            if position > 0.5:
-                if net_shares == 0:
-                    prices_all.loc[date, 'shares'] = 1000
-                    net_shares += 1000
-                elif net_shares == -1000:
-                    prices_all.loc[date, 'shares'] = 2000
-                    net_shares += 2000
-            # SELL
-            elif position < 0:
-                if net_shares == 0:
-                    prices_all.loc[date, 'shares'] = -1000
-                    net_shares -= 1000
-                elif net_shares == 1000:
-                    prices_all.loc[date, 'shares'] = -2000
-                    net_shares -= 2000
-            # HOLD
-            else:
-                prices_all.loc[date, 'shares'] = None
+        return self.policy_trades(prices_all, ed)
+
+    def policy_trades(self, prices_all, ed):
+        """
+        Trades from the learner output in prices_all['Y_out'], days without a trade are dropped
+        """
+        # BUY above 0.5, SELL below 0, HOLD otherwise
+        y_out = prices_all['Y_out'].to_numpy()
+        trades, net_shares = signals_to_trades(y_out > 0.5, y_out < 0)
+        prices_all['shares'] = trades
 
         if net_shares != 0:
             if net_shares < 0:
@@ -136,14 +152,123 @@ class StrategyLearner(object):
         prices_all.dropna(inplace=True)
         return prices_all[['shares']]
 
+    def load_portfolio_features(self, symbols, sd=dt.datetime(2008, 1, 1), ed=dt.datetime(2009, 1, 1)):
+        """
+        load_features for many symbols from a single get_data call
+        Indicators of the symbols that trade on every day of the range are computed in one batched pass
+        :return: dict symbol -> features, the same frame load_features returns for that symbol
+        """
+        prices = ut.get_data(symbols, pd.date_range(sd, ed), addSPY=False)
+        prices = prices.dropna(how='all')
+
+        complete = [symbol for symbol in symbols if prices[symbol].notna().all()]
+        indicators = batch_indicators(prices[complete], INDICATOR_WINDOWS) if complete else {}
+
+        features = {}
+        for symbol in symbols:
+            if symbol in complete:
+                prices_all = prices[[symbol]].copy()
+                for name in INDICATOR_WINDOWS:
+                    prices_all[name] = indicators[name][symbol].to_numpy()
+                features[symbol] = prices_all[[symbol, 'rsi', 'momentum', 'williamsR']]
+            else:
+                features[symbol] = self.compute_indicators(prices[[symbol]].dropna())
+        return features
+
+    def add_evidence_portfolio(self, symbols, sd=dt.datetime(2008, 1, 1), ed=dt.datetime(2009, 1, 1), sv=100000, pooled=True, n_jobs=None):
+        """
+        Train on many symbols at once
+        :param pooled: True trains this learner on the pooled features of all symbols,
+            False trains one StrategyLearner per symbol on a process pool (seeded from np.random)
+        :param n_jobs: Number of worker processes for pooled=False, 1 trains in this process
+        """
+        features = self.load_portfolio_features(symbols, sd, ed)
+
+        if pooled:
+            train_x, train_y = [], []
+            for symbol in symbols:
+                prices_all_no_0 = features[symbol].dropna()
+                train_x.append(prices_all_no_0[['rsi', 'momentum', 'williamsR']].to_numpy())
+                train_y.append(self.discretize(df=prices_all_no_0, symbol=symbol, window=LABEL_WINDOW))
+            self.train_x = np.concatenate(train_x)
+            self.train_y = np.concatenate(train_y)
+            self.learner.add_evidence(self.train_x, self.train_y)
+            self.symbol_learners = None
+            return
+
+        seeds = np.random.randint(np.iinfo(np.int32).max, size=len(symbols))
+        params = dict(verbose=False, impact=self.impact, commission=self.commission, learner=self.learner_class,
+                      leaf_size=self.leaf_size, feature_cache=self.feature_cache, bags=self.bags, bins=self.bins)
+        jobs = [(symbol, sd, ed, sv, features[symbol], params, seed) for symbol, seed in zip(symbols, seeds)]
+        if n_jobs == 1:
+            learners = [_train_symbol_learner(job) for job in jobs]
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                learners = list(pool.map(_train_symbol_learner, jobs))
+        self.symbol_learners = dict(zip(symbols, learners))
+
+    def testPolicy_portfolio(self, symbols, sd=dt.datetime(2009, 1, 1), ed=dt.datetime(2010, 1, 1), sv=100000):
+        """
+        testPolicy for many symbols after add_evidence_portfolio
+        :return: One orders frame (Symbol and shares columns, sorted by date) that compute_portvals simulates in one pass
+        """
+        features = self.load_portfolio_features(symbols, sd, ed)
+
+        orders = []
+        for symbol in symbols:
+            learner = self.symbol_learners[symbol] if self.symbol_learners else self
+            prices_all = features[symbol].dropna().copy()
+            prices_all['Y_out'] = learner.predict(prices_all)
+            trades = self.policy_trades(prices_all, ed)
+            trades.insert(0, 'Symbol', symbol)
+            orders.append(trades)
+        return pd.concat(orders).sort_index(kind='stable')
+
+    def predict(self, features):
+        """
+        Learner output (Y_out) for the rows of features that have every indicator
+        """
+        features = features.dropna()
+        return pd.Series(self.learner.query(features[['rsi', 'momentum', 'williamsR']].to_numpy()), index=features.index, name='Y_out')
+
+    def save(self, path):
+        """
+        Save the trained learner with the parameters its features and labels were built with (BagLearner.save format)
+        """
+        if self.symbol_learners:
+            raise ValueError("StrategyLearner: per symbol learners can't be saved, train with pooled=True")
+        if not isinstance(self.learner, BagLearner):
+            raise TypeError("StrategyLearner: only BagLearner models can be saved")
+        metadata = {'impact': self.impact, 'commission': self.commission, 'leaf_size': self.leaf_size, 'bags': self.bags, 'bins': self.bins,
+                    'indicator_windows': INDICATOR_WINDOWS, 'label_window': LABEL_WINDOW,
+                    'buy_threshold': self.impact * 10, 'sell_threshold': -1 * (self.impact * 20)}
+        self.learner.save(path, metadata)
+
+    @classmethod
+    def load(cls, path, verbose=False, feature_cache=False):
+        """
+        Load a StrategyLearner saved with save, ready for testPolicy without training
+        """
+        learner, metadata = BagLearner.load(path, verbose=verbose)
+        if metadata.get('indicator_windows') != INDICATOR_WINDOWS:
+            raise ValueError(f"StrategyLearner: model was trained on indicator windows {metadata.get('indicator_windows')}, "
+                             f"not {INDICATOR_WINDOWS}")
+
+        strategy_learner = cls(verbose=verbose, impact=metadata['impact'], commission=metadata['commission'],
+                               leaf_size=metadata['leaf_size'], feature_cache=feature_cache, bags=metadata['bags'], bins=metadata.get('bins'))
+        strategy_learner.learner = learner
+        return strategy_learner
+
     def compute_indicators(self, prices_all):
-        rsi = calculate_RSI_EMV(prices_all.copy(), window=4, plot=False, ret_val=True)
-        williamsR = calculate_williamsR(prices_all.copy(), window=14, plot=False, ret_val=True)
-        momentum = calculate_momentum(prices_all.copy(), window=14, plot=False, ret_val=True)
-        prices_all['rsi'] = rsi[['RSI_EMV']]
-        prices_all['momentum'] = momentum[['momentum']]
-        prices_all['williamsR'] = williamsR[['williams']]
-        return prices_all
+        # prices_all only holds the traded symbol at this point
+        symbol = prices_all.columns[0]
+        if self.feature_cache:
+            indicators = cached_indicators(prices_all, symbol, INDICATOR_WINDOWS)
+        else:
+            indicators = {name: frame[symbol].to_numpy() for name, frame in batch_indicators(prices_all, INDICATOR_WINDOWS).items()}
+        # Built without copies, so cache hits stay memory maps of the cache files
+        return pd.DataFrame({symbol: prices_all[symbol].to_numpy(), 'rsi': indicators['rsi'], 'momentum': indicators['momentum'],
+                             'williamsR': indicators['williamsR']}, index=prices_all.index, copy=False)
 
     def bench_mark(self, symbol="JPM", sd=dt.datetime(2010, 1, 1), ed=dt.datetime(2011, 12, 31), sv=100000):
         port_val = ut.get_data([symbol], pd.date_range(sd, ed))
@@ -153,10 +278,10 @@ class StrategyLearner(object):
         return "narora62"
 
     def run_strategy_learner(self, df_trades, symbols, start_date, end_date, save_fig, fig_name='Strategy-Learner.png'):
-        port_val_sl = compute_portvals(orders=df_trades, start_val=100000, commission=9.95, impact=0.005)
+        port_val_sl = compute_portvals(orders=df_trades, start_val=100000, commission=9.95, impact=0.005, symbol=symbols)
 
         portval_bench = self.bench_mark(symbols, start_date, end_date, 100000)
-        port_val_bench = compute_portvals(orders=portval_bench, start_val=100000, commission=9.95, impact=0.005)
+        port_val_bench = compute_portvals(orders=portval_bench, start_val=100000, commission=9.95, impact=0.005, symbol=symbols)
 
         cum_ret_sl, avg_daily_ret_sl, std_daily_ret_sl, sharpe_ratio_sl = compute_optimized_portfolio_stats(port_val_sl['portval'])
         cum_ret_bchm, avg_daily_ret_bchm, std_daily_ret_bchm, sharpe_ratio_bchm = compute_optimized_portfolio_stats(port_val_bench['portval'])
@@ -195,6 +320,7 @@ class StrategyLearner(object):
         colors = {'Benchmark': 'green', 'Strategy Learner': '#1f77b4'}
 
         # Setup plot info and save fig
+        plt = ut.get_pyplot()
         ax = pd.concat([port_vals_bchm_norm, port_val_sl_norm], axis=1).plot(title="Normalized Benchmark with Strategy Learner", fontsize=12, color=['green', 'red'])
         ax.set_xlabel("Date")
         ax.set_ylabel("Normalized Portfolio")
@@ -205,6 +331,36 @@ class StrategyLearner(object):
         else:
             plt.show()
 
+
+def _train_symbol_learner(job):
+    symbol, sd, ed, sv, features, params, seed = job
+    np.random.seed(seed)
+    learner = StrategyLearner(**params)
+    learner.add_evidence(symbol=symbol, sd=sd, ed=ed, sv=sv, features=features)
+    return learner
+
+
+def label_forward_returns(prices, window, buy_threshold, sell_threshold):
+    """
+    Vectorized forward return labeler
+    :param prices: array (days,) or (days x symbols)
+    :param window: horizon in days, or a list of horizons
+    :return: ratio, labels with the shape of prices (with a leading horizon axis for a list of windows)
+        labels are 1 where ratio > buy_threshold, -1 where ratio < sell_threshold, else 0
+    """
+    if not np.isscalar(window):
+        labelled = [label_forward_returns(prices, w, buy_threshold, sell_threshold) for w in window]
+        return np.stack([ratio for ratio, _ in labelled]), np.stack([labels for _, labels in labelled])
+
+    prices = np.asarray(prices, dtype=np.float64)
+    days = prices.shape[0]
+    ratio = np.zeros(prices.shape)
+    if window < days:
+        ratio[:days - window] = (prices[window:] / prices[:days - window]) - 1
+    labels = np.select([ratio > buy_threshold, ratio < sell_threshold], [1, -1], 0)
+    return ratio, labels
+
+
 # if __name__ == '__main__':
 #     start_date = dt.datetime(2008, 1, 1)
 #     end_date = dt.datetime(2009, 12, 31)
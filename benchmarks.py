@@ -0,0 +1,183 @@
+"""
+Micro-benchmarks of the data loader, the simulator and the learners on the bundled data
+python benchmarks.py --output bench.json                      # run and save the timings
+python benchmarks.py --output new.json --baseline bench.json  # also flag regressions against a saved run
+A benchmark regresses when its best time is more than --threshold times the baseline best time
+"""
+import argparse
+import datetime as dt
+import glob
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+import util as ut
+from BagLearner import BagLearner
+from ManualStrategy import testPolicy as testPolicy_ms
+from RTLearner import RTLearner
+from StrategyLearner import StrategyLearner
+from marketsimcode import compute_portvals
+
+
+def author():
+    return 'narora62'
+
+
+def benchmarks():
+    """
+    :return: list of (name, setup) pairs, setup() returns the callable that is timed
+    """
+    cases = []
+    dates = pd.date_range(dt.datetime(2008, 1, 1), dt.datetime(2009, 12, 31))
+    universe = ut.get_symbol_list("sp5002012")
+    for count in (1, 50, 500):
+        symbols = universe[:count]
+
+        def cold(symbols=symbols):
+            ut.price_cache.clear()
+            ut.get_data(symbols, dates)
+
+        cases.append((f"get_data[{count},cold]", lambda cold=cold: cold))
+        cases.append((f"get_data[{count},warm]", lambda symbols=symbols: lambda: ut.get_data(symbols, dates)))
+
+    for orders_file in sorted(glob.glob("orders/*.csv")):
+        cases.append((f"compute_portvals[{orders_file}]", lambda orders_file=orders_file: lambda: compute_portvals(orders_file)))
+
+    for rows in (1000, 10000, 100000):
+        cases.append((f"RTLearner.add_evidence[{rows}]", lambda rows=rows: _train(RTLearner(leaf_size=1), rows)))
+        cases.append((f"RTLearner.query[{rows}]", lambda rows=rows: _query(RTLearner(leaf_size=1), rows)))
+    cases.append(("RTLearner.add_evidence[100000,bins]", lambda: _train(RTLearner(leaf_size=1, bins=256), 100000)))
+    for rows in (1000, 10000):
+        cases.append((f"BagLearner.add_evidence[{rows}]", lambda rows=rows: _train(_bag_learner(), rows)))
+        cases.append((f"BagLearner.query[{rows}]", lambda rows=rows: _query(_bag_learner(), rows)))
+
+    cases.append(("StrategyLearner.add_evidence", _strategy_learner_add_evidence))
+    cases.append(("StrategyLearner.testPolicy", _strategy_learner_test_policy))
+    cases.append(("StrategyLearner.testPolicy[feature_cache]", lambda: _strategy_learner_test_policy(feature_cache=True)))
+    cases.append(("ManualStrategy.testPolicy", lambda: lambda: testPolicy_ms("JPM", dt.datetime(2008, 1, 1), dt.datetime(2009, 12, 31), 100000)))
+    return cases
+
+
+def _data(rows, seed=0):
+    rng = np.random.RandomState(seed)
+    xdata = rng.rand(rows, 3)
+    return xdata, xdata.sum(axis=1) + rng.normal(0, 0.1, rows)
+
+
+def _bag_learner():
+    return BagLearner(learner=RTLearner, kwargs={'leaf_size': 5}, bags=15)
+
+
+def _train(learner, rows):
+    xdata, ydata = _data(rows)
+    return lambda: learner.add_evidence(xdata, ydata)
+
+
+def _query(learner, rows):
+    xdata, ydata = _data(rows)
+    learner.add_evidence(xdata, ydata)
+    points, _ = _data(rows, seed=1)
+    return lambda: learner.query(points)
+
+
+def _strategy_learner_add_evidence():
+    learner = StrategyLearner(impact=0.005, commission=9.95)
+    return lambda: learner.add_evidence("JPM", dt.datetime(2008, 1, 1), dt.datetime(2009, 12, 31), 100000)
+
+
+def _strategy_learner_test_policy(feature_cache=False):
+    # With the feature cache, every timed call after the warm up is a cache hit
+    learner = StrategyLearner(impact=0.005, commission=9.95, feature_cache=feature_cache)
+    learner.add_evidence("JPM", dt.datetime(2008, 1, 1), dt.datetime(2009, 12, 31), 100000)
+    return lambda: learner.testPolicy("JPM", dt.datetime(2010, 1, 1), dt.datetime(2011, 12, 31), 100000)
+
+
+def run(repeat=5, pattern=None):
+    """
+    Time every benchmark repeat times after one untimed warm up call
+    :return: dict name -> {'best', 'median', 'repeat'} in seconds
+    """
+    results = {}
+    with _scratch_feature_cache():
+        for name, setup in benchmarks():
+            if pattern and pattern not in name:
+                continue
+            np.random.seed(0)
+            func = setup()
+            func()
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                func()
+                times.append(time.perf_counter() - start)
+            results[name] = {'best': min(times), 'median': float(np.median(times)), 'repeat': repeat}
+            print(f"{name:<45} best {min(times) * 1000:10.2f} ms   median {np.median(times) * 1000:10.2f} ms")
+    return results
+
+
+@contextmanager
+def _scratch_feature_cache():
+    # Feature cache benchmarks write to a temporary directory that is removed afterwards, never into data/features
+    previous = os.environ.get("FEATURE_CACHE_DIR")
+    os.environ["FEATURE_CACHE_DIR"] = tempfile.mkdtemp(prefix="features-")
+    try:
+        yield
+    finally:
+        shutil.rmtree(os.environ["FEATURE_CACHE_DIR"], ignore_errors=True)
+        if previous is None:
+            del os.environ["FEATURE_CACHE_DIR"]
+        else:
+            os.environ["FEATURE_CACHE_DIR"] = previous
+
+
+def compare(results, baseline, threshold=1.2):
+    """
+    :return: names of the benchmarks whose best time is more than threshold times the baseline
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['best'] / baseline[name]['best']
+        flag = "REGRESSION" if ratio > threshold else ("faster" if ratio < 1 / threshold else "")
+        print(f"{name:<45} {ratio:6.2f}x  {flag}")
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks on the bundled data")
+    parser.add_argument("--output", help="json file the timings are written to")
+    parser.add_argument("--baseline", help="json file of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=1.2, help="slowdown ratio flagged as a regression")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--filter", help="only run benchmarks whose name contains this")
+    args = parser.parse_args()
+
+    results = run(args.repeat, args.filter)
+    if args.output:
+        meta = {'date': dt.datetime.now().isoformat(), 'python': platform.python_version(), 'numpy': np.__version__,
+                'pandas': pd.__version__, 'machine': platform.platform()}
+        with open(args.output, "w") as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Import time regression check, run it after touching module level imports:
+python check_imports.py
+Every module is imported in a fresh interpreter, the check fails when one of them loads matplotlib
+or takes longer than the budget (seconds, IMPORT_BUDGET in the environment)
+"""
+import os
+import subprocess
+import sys
+
+MODULES = ["util", "indicators", "marketsimcode", "RTLearner", "BagLearner", "StrategyLearner", "ManualStrategy",
+           "experiment1", "experiment2", "walkforward"]
+IMPORT_BUDGET = float(os.environ.get("IMPORT_BUDGET", 2.0))
+
+CHECK = """
+import sys, time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start, "matplotlib" in sys.modules)
+"""
+
+
+def author():
+    return 'narora62'
+
+
+def import_time(module):
+    """
+    :return: (seconds to import module in a fresh interpreter, whether matplotlib got loaded)
+    """
+    output = subprocess.run([sys.executable, "-c", CHECK.format(module=module)], check=True, capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split()
+    return float(output[-2]), output[-1] == "True"
+
+
+def main():
+    failed = []
+    for module in MODULES:
+        seconds, loads_matplotlib = import_time(module)
+        print(f"{module:<16} {seconds:.3f}s{'  (loads matplotlib)' if loads_matplotlib else ''}")
+        if loads_matplotlib or seconds > IMPORT_BUDGET:
+            failed.append(module)
+
+    if failed:
+        print(f"Import check failed: {', '.join(failed)}")
+        sys.exit(1)
+    print("Import check passed")
+
+
+if __name__ == '__main__':
+    main()
@@ -10,8 +10,8 @@ See DATA DETAILS, DATES & RULES section above for commission and impact informat
 """
 import datetime as dt
 import pandas as pd
-from matplotlib import pyplot as plt
 
+import util as ut
 from ManualStrategy import testPolicy as testPolicy_ms
 from StrategyLearner import StrategyLearner
 from marketsimcode import compute_portvals, compute_optimized_portfolio_stats
@@ -36,7 +36,7 @@ def experiment1(save_fig=False, fig_name='Experiment1.png'):
         portval_ms = testPolicy_ms(symbols, start_date_o, end_date_o, 100000)
     else:
         portval_ms = testPolicy_ms(symbols, start_date, end_date, 100000)
-    port_val_ms = compute_portvals(orders=portval_ms, start_val=100000, commission=commission, impact=impact)
+    port_val_ms = compute_portvals(orders=portval_ms, start_val=100000, commission=commission, impact=impact, symbol=symbols)
 
     sl = StrategyLearner(verbose=False, impact=impact, commission=9.95)
     sl.add_evidence(symbol=symbols, sd=start_date, ed=end_date, sv=100000)  # training phase
@@ -46,13 +46,13 @@ def experiment1(save_fig=False, fig_name='Experiment1.png'):
     else:
         portval_sl = sl.testPolicy(symbols, start_date, end_date, 100000)
 
-    port_val_sl = compute_portvals(orders=portval_sl, start_val=100000, commission=commission, impact=impact)
+    port_val_sl = compute_portvals(orders=portval_sl, start_val=100000, commission=commission, impact=impact, symbol=symbols)
 
     if test_out_sample:
         portval_bench = sl.bench_mark(symbols, start_date_o, end_date_o, 100000)
     else:
         portval_bench = sl.bench_mark(symbols, start_date, end_date, 100000)
-    port_val_bench = compute_portvals(orders=portval_bench, start_val=100000, commission=commission, impact=impact)
+    port_val_bench = compute_portvals(orders=portval_bench, start_val=100000, commission=commission, impact=impact, symbol=symbols)
 
     # Compute metrics for Manual Strategy, Strategy Learner and Benchmark
     cum_ret_ms, avg_daily_ret_ms, std_daily_ret_ms, sharpe_ratio_ms = compute_optimized_portfolio_stats(port_val_ms['portval'])
@@ -100,6 +100,7 @@ def experiment1(save_fig=False, fig_name='Experiment1.png'):
     colors = {'Benchmark': 'green', 'Manual Strategy': 'red', 'Optimized Learner': 'yellow', 'Strategy Learner': '#1f77b4'}
 
     # Setup plot info and save fig
+    plt = ut.get_pyplot()
     ax = pd.concat([port_val_ms, port_val_sl, port_val_bench], axis=1).plot(title="Normalized Benchmark with Manual Strategy and Strategy Learner", fontsize=12, color=colors)
     ax.set_xlabel("Date")
     ax.set_ylabel("Normalized Portfolio")
@@ -9,11 +9,15 @@ and data should be submitted as experiment2.py.
 See the ‘Report’ section on Experiment 2 for more details.
 """
 import datetime as dt
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 import pandas as pd
-from matplotlib import pyplot as plt
 
+import util as ut
 from StrategyLearner import StrategyLearner
-from marketsimcode import compute_portvals, compute_optimized_portfolio_stats
+from marketsimcode import compute_portvals, compute_optimized_portfolio_stats, batch_portfolio_stats
 
 
 def author():
@@ -45,11 +49,11 @@ def experiment2(save_fig=False ,fig_name='Experiment2.png'):
     strategy_4 = learner_4.testPolicy(symbols, start_date, end_date, 100000)
     strategy_5 = learner_5.testPolicy(symbols, start_date, end_date, 100000)
 
-    port_val_1 = compute_portvals(orders=strategy_1, start_val=100000, commission=commission, impact=0.0090)
-    port_val_2 = compute_portvals(orders=strategy_2, start_val=100000, commission=commission, impact=0.0050)
-    port_val_3 = compute_portvals(orders=strategy_3, start_val=100000, commission=commission, impact=0.0010)
-    port_val_4 = compute_portvals(orders=strategy_4, start_val=100000, commission=commission, impact=0.0005)
-    port_val_5 = compute_portvals(orders=strategy_5, start_val=100000, commission=commission, impact=0.0000)
+    port_val_1 = compute_portvals(orders=strategy_1, start_val=100000, commission=commission, impact=0.0090, symbol=symbols)
+    port_val_2 = compute_portvals(orders=strategy_2, start_val=100000, commission=commission, impact=0.0050, symbol=symbols)
+    port_val_3 = compute_portvals(orders=strategy_3, start_val=100000, commission=commission, impact=0.0010, symbol=symbols)
+    port_val_4 = compute_portvals(orders=strategy_4, start_val=100000, commission=commission, impact=0.0005, symbol=symbols)
+    port_val_5 = compute_portvals(orders=strategy_5, start_val=100000, commission=commission, impact=0.0000, symbol=symbols)
 
     # Compute metrics for Manual Strategy, Strategy Learner and Benchmark
     cum_ret_sl_1, avg_daily_ret_sl_1, std_daily_ret_sl_1, sharpe_ratio_sl_1 = compute_optimized_portfolio_stats(port_val_1['portval'])
@@ -117,6 +121,7 @@ def experiment2(save_fig=False ,fig_name='Experiment2.png'):
     port_val_5.rename(columns={'portval': 'Strategy Learner 5 (impact: 0.000)'}, inplace=True)
 
     # Setup plot info and save fig
+    plt = ut.get_pyplot()
     ax = pd.concat([port_val_1, port_val_2, port_val_3, port_val_4, port_val_5], axis=1).plot(title="Strategy Learners with different Impacts", fontsize=12)
     ax.set_xlabel("Date")
     ax.set_ylabel("Normalized Portfolio")
@@ -127,5 +132,49 @@ def experiment2(save_fig=False ,fig_name='Experiment2.png'):
         plt.show()
 
 
+def impact_sweep(symbol='JPM', sd=dt.datetime(2008, 1, 1), ed=dt.datetime(2009, 12, 31), impacts=(0.0090, 0.0050, 0.0010, 0.0005, 0.0000),
+                 commissions=(9.95,), leaf_sizes=(5,), bags=(15,), sv=100000, n_jobs=None, seed=None):
+    """
+    Train and backtest a StrategyLearner in-sample for every point of the impact x commission x leaf_size x bags grid
+    Prices and indicator features are loaded once here, the grid points then run on a process pool
+    :param n_jobs: Number of worker processes, 1 runs the grid in this process
+    :param seed: Base seed, grid point i is trained with np.random.seed(seed + i) for reproducible results
+    :return: DataFrame with one row per grid point
+    """
+    features = StrategyLearner().load_features(symbol, sd, ed)
+    prices = ut.get_data([symbol], pd.date_range(sd, ed))
+
+    grid = list(itertools.product(impacts, commissions, leaf_sizes, bags))
+    points = [(symbol, sd, ed, sv, features, prices, point, None if seed is None else seed + i) for i, point in enumerate(grid)]
+
+    if n_jobs == 1:
+        results = [_run_sweep_point(point) for point in points]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            results = list(pool.map(_run_sweep_point, points))
+
+    # Score all equity curves in one pass, the curves start and end on the dates of their first and last trade
+    rows, port_vals, traded = zip(*results)
+    port_vals = pd.concat(port_vals, axis=1)
+    stats = batch_portfolio_stats(port_vals, pd.concat(traded, axis=1).reindex(port_vals.index))
+    return pd.concat([pd.DataFrame(list(rows)), stats.reset_index(drop=True)], axis=1)
+
+
+def _run_sweep_point(args):
+    symbol, sd, ed, sv, features, prices, (impact, commission, leaf_size, bags), seed = args
+    if seed is not None:
+        np.random.seed(seed)
+
+    learner = StrategyLearner(verbose=False, impact=impact, commission=commission, leaf_size=leaf_size, bags=bags)
+    learner.add_evidence(symbol=symbol, sd=sd, ed=ed, sv=sv, features=features)  # training phase
+    trades = learner.testPolicy(symbol, sd, ed, sv, features=features)
+
+    port_val = compute_portvals(orders=trades.copy(), start_val=sv, commission=commission, impact=impact, prices=prices, symbol=symbol)['portval']
+    traded = (trades['shares'] * prices.loc[trades.index, symbol]).abs()
+    row = {'impact': impact, 'commission': commission, 'leaf_size': leaf_size, 'bags': bags, 'trades': len(trades),
+           'final_value': port_val.iloc[-1]}
+    return row, port_val, traded.groupby(level=0).sum()
+
+
 if __name__ == '__main__':
     experiment2()
@@ -1,18 +1,173 @@
-import matplotlib.pyplot as plt
+import hashlib
+import os
+from collections import deque
+
+import numpy as np
 import pandas as pd
 
-from util import get_data
+from instrument import timed, rows_of_arg
+from util import get_data, get_pyplot
 
 
 def author():
     return "nitarora"
 
 
+@timed("indicators.SMA", rows=rows_of_arg("prices"))
+def batch_SMA(prices, window):
+    """
+    Price / SMA ratio for every column of prices (days x symbols), prices are normalized to the first day
+    """
+    prices = prices / prices.iloc[0]
+    return prices / prices.rolling(window=window).mean()
+
+
+@timed("indicators.momentum", rows=rows_of_arg("prices"))
+def batch_momentum(prices, window):
+    return (prices / prices.shift(-window)) - 1
+
+
+@timed("indicators.RSI_EMV", rows=rows_of_arg("prices"))
+def batch_RSI_EMV(prices, window):
+    """
+    RSI with exponential moving averages of gains and losses, for every column of prices (days x symbols)
+    prices are expected to be filled (no NaN), the first day has no diff and is NaN
+    """
+    diff = prices.diff()
+    diff = diff[1:]
+
+    up_diff, down_diff = diff.clip(lower=0), diff.clip(upper=0)
+
+    total_average_gain = up_diff.ewm(span=window).mean()
+    total_average_loss = down_diff.abs().ewm(span=window).mean()
+
+    rs_emv = (total_average_gain / total_average_loss).abs()
+
+    return (100.0 - 100.0 / (1.0 + rs_emv)).reindex(prices.index)
+
+
+def _TRIX_emas(prices, window):
+    prices = prices / prices.iloc[0]
+    ex1 = prices.ewm(span=window, min_periods=1).mean()
+    ex2 = ex1.ewm(span=window, min_periods=1).mean()
+    ex3 = ex2.ewm(span=window, min_periods=1).mean()
+    return ex1, ex2, ex3
+
+
+@timed("indicators.TRIX", rows=rows_of_arg("prices"))
+def batch_TRIX(prices, window):
+    ex3 = _TRIX_emas(prices, window)[2]
+    return 10000 * (ex3.diff() / ex3)
+
+
+@timed("indicators.williamsR", rows=rows_of_arg("prices"))
+def batch_williamsR(prices, window):
+    prices = prices / prices.iloc[0]
+    max = prices.rolling(window=window).max()
+    min = prices.rolling(window=window).min()
+    return 100.0 * (prices - max) / (max - min)
+
+
+def batch_indicators(prices, windows):
+    """
+    All requested indicators for every symbol in one pass, no copies of the input and no plotting
+    :param prices: DataFrame (days x symbols)
+    :param windows: dict indicator name -> window, e.g. {'rsi': 4, 'williamsR': 14, 'momentum': 14}
+    :return: dict indicator name -> DataFrame (days x symbols) aligned with prices
+    """
+    return {name: BATCH_INDICATORS[name](prices, window) for name, window in windows.items()}
+
+
+def feature_cache_dir():
+    return os.environ.get("FEATURE_CACHE_DIR", os.path.join(os.environ.get("MARKET_DATA_DIR", "data/"), "features"))
+
+
+def feature_cache_max_bytes():
+    return int(os.environ.get("FEATURE_CACHE_BYTES", 64 * 1024 * 1024))
+
+
+@timed("indicators.cached_indicators", rows=rows_of_arg("prices"))
+def cached_indicators(prices, symbol, windows, cache_dir=None, max_bytes=None):
+    """
+    batch_indicators for one symbol, backed by an on disk cache of .npy feature columns
+    Entries are keyed by symbol, date range, indicator and window, plus a digest of the prices so
+    changed data never hits a stale entry. A hit is a read only memory map of the file, no copy
+    The cache is kept under max_bytes (FEATURE_CACHE_BYTES), least recently used entries are deleted first
+    :param prices: DataFrame with a symbol column, the range the indicators are computed over
+    :param windows: dict indicator name -> window, as for batch_indicators
+    :return: dict indicator name -> array aligned with prices.index
+    """
+    if not len(prices.index):
+        return {name: frame[symbol].to_numpy() for name, frame in batch_indicators(prices[[symbol]], windows).items()}
+
+    if cache_dir is None:
+        cache_dir = feature_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+
+    values = np.ascontiguousarray(prices[symbol].to_numpy(dtype=np.float64))
+    dates = prices.index.values.astype("datetime64[ns]").view("i8")
+    digest = hashlib.sha1(values.tobytes() + dates.tobytes()).hexdigest()[:16]
+    start, end = prices.index[0], prices.index[-1]
+
+    features, missing = {}, {}
+    for name, window in windows.items():
+        path = os.path.join(cache_dir, f"{symbol}_{start:%Y%m%d}_{end:%Y%m%d}_{name}_{window}_{digest}.npy")
+        try:
+            features[name] = np.load(path, mmap_mode="r")
+            # The modification time orders the entries for eviction
+            os.utime(path)
+        except FileNotFoundError:
+            missing[name] = path
+
+    if missing:
+        computed = batch_indicators(prices[[symbol]], {name: windows[name] for name in missing})
+        for name, path in missing.items():
+            features[name] = computed[name][symbol].to_numpy(dtype=np.float64)
+            # Write to a temporary file first, concurrent readers never see a partial entry
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, features[name])
+            os.replace(tmp_path, path)
+        prune_feature_cache(cache_dir, feature_cache_max_bytes() if max_bytes is None else max_bytes)
+    return features
+
+
+def prune_feature_cache(cache_dir=None, max_bytes=None):
+    """
+    Delete the least recently used feature cache entries until the cache fits in max_bytes
+    """
+    if cache_dir is None:
+        cache_dir = feature_cache_dir()
+    if max_bytes is None:
+        max_bytes = feature_cache_max_bytes()
+
+    entries = []
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            if entry.name.endswith(".npy"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
 def calculate_SMA(port_val, window, plot=False, ret_val=False, symbol='JPM'):
+    sma = batch_SMA(port_val[symbol], window)
     port_val = port_val / port_val.iloc[0]
-    port_val["SMA"] = port_val[symbol].rolling(window=window).mean()
-    port_val['SMA'] = port_val[symbol] / port_val['SMA']
+    port_val['SMA'] = sma
     if plot:
+        plt = get_pyplot()
         ax = port_val.plot(title='SMA (Simple Moving Average, Window=20 days)', fontsize=8)
         ax.set_xlabel("Date")
         ax.set_ylabel("Normalized Price")
@@ -26,8 +181,9 @@ def calculate_SMA(port_val, window, plot=False, ret_val=False, symbol='JPM'):
 
 
 def calculate_momentum(port_val, window, plot=False, ret_val=False, symbol='JPM'):
-    port_val['momentum'] = (port_val / port_val.shift(-window)) - 1
+    port_val['momentum'] = batch_momentum(port_val, window)
     if plot:
+        plt = get_pyplot()
         plt.rcParams['axes.grid'] = True
         plt.subplot(2, 1, 1)
         ax = port_val[symbol].plot(title=f'Stock Price ({symbol})', fontsize=8)
@@ -48,22 +204,10 @@ def calculate_momentum(port_val, window, plot=False, ret_val=False, symbol='JPM'
 
 
 def calculate_RSI_EMV(port_val, window, plot=False, ret_val=False, symbol='JPM'):
-    diff = port_val.dropna().diff()
-    diff = diff[1:]
-
-    up_diff, down_diff = diff.copy(), diff.copy()
-
-    up_diff[up_diff < 0] = 0
-    down_diff[down_diff > 0] = 0
-
-    total_average_gain = up_diff.ewm(span=window).mean()
-    total_average_loss = down_diff.abs().ewm(span=window).mean()
-
-    rs_emv = abs(total_average_gain / total_average_loss)
-
-    port_val['RSI_EMV'] = 100.0 - 100.0 / (1.0 + rs_emv)
+    port_val['RSI_EMV'] = batch_RSI_EMV(port_val.dropna(), window)
 
     if plot:
+        plt = get_pyplot()
         plt.rcParams['axes.grid'] = True
         plt.subplot(2, 1, 1)
         ax = port_val[symbol].plot(title=f'Stock Price ({symbol})', fontsize=8)
@@ -89,13 +233,15 @@ def calculate_RSI_EMV(port_val, window, plot=False, ret_val=False, symbol='JPM')
 
 
 def calculate_TRIX(port_val, window, plot=False, ret_val=False, symbol='JPM'):
+    ex1, ex2, ex3 = _TRIX_emas(port_val[symbol], window)
     port_val = port_val / port_val.iloc[0]
-    port_val['ex1'] = port_val[symbol].ewm(span=window, min_periods=1).mean()
-    port_val['ex2'] = port_val['ex1'].ewm(span=window, min_periods=1).mean()
-    port_val['ex3'] = port_val['ex2'].ewm(span=window, min_periods=1).mean()
+    port_val['ex1'] = ex1
+    port_val['ex2'] = ex2
+    port_val['ex3'] = ex3
 
     port_val['trix'] = 10000 * (port_val['ex3'].diff() / port_val['ex3'])
     if plot:
+        plt = get_pyplot()
         plt.rcParams['axes.grid'] = True
         ax = port_val[['ex1', 'ex2', 'ex3', symbol]].plot(title=f'Stock Price {symbol}', fontsize=8)
         ax.set_xlabel("Date")
@@ -109,11 +255,11 @@ def calculate_TRIX(port_val, window, plot=False, ret_val=False, symbol='JPM'):
 
 
 def calculate_williamsR(port_val, window, plot=False, ret_val=False, symbol='AAPL'):
+    williams = batch_williamsR(port_val, window)
     port_val = port_val / port_val.iloc[0]
-    max = port_val.rolling(window=window).max()
-    min = port_val.rolling(window=window).min()
-    port_val['williams'] = 100.0 * (port_val - max) / (max - min)
+    port_val['williams'] = williams
     if plot:
+        plt = get_pyplot()
         plt.rcParams['axes.grid'] = True
         plt.subplot(2, 1, 1)
         ax = port_val[symbol].plot(title=f'Stock Price {symbol}', fontsize=8)
@@ -135,6 +281,160 @@ def calculate_williamsR(port_val, window, plot=False, ret_val=False, symbol='AAP
         return port_val
 
 
+class _StreamingEWM(object):
+    def __init__(self, span, min_periods=0):
+        """
+        O(1) state of pandas' ewm(span=span, adjust=True).mean(), same recurrence so values match exactly
+        """
+        com = (span - 1) / 2
+        self.old_wt_factor = 1.0 - 1.0 / (1.0 + com)
+        self.min_periods = max(int(min_periods), 1)
+        self.weighted = None
+        self.old_wt = 1.0
+        self.nobs = 0
+
+    def update(self, value):
+        is_observation = value == value
+        self.nobs += is_observation
+        if self.weighted is None:
+            self.weighted = value
+        elif self.weighted == self.weighted:
+            self.old_wt *= self.old_wt_factor
+            if is_observation:
+                # avoid numerical errors on constant series
+                if self.weighted != value:
+                    self.weighted = self.old_wt * self.weighted + value
+                    self.weighted = self.weighted / (self.old_wt + 1.0)
+                self.old_wt += 1.0
+        elif is_observation:
+            self.weighted = value
+        return self.weighted if self.nobs >= self.min_periods else float('nan')
+
+
+class StreamingRSI_EMV(object):
+    def __init__(self, window):
+        """
+        Streaming batch_RSI_EMV, update(price) returns the RSI of the newest bar (NaN on the first one)
+        """
+        self.gain = _StreamingEWM(window)
+        self.loss = _StreamingEWM(window)
+        self.last_price = None
+        self.value = float('nan')
+
+    def update(self, price):
+        if self.last_price is not None:
+            diff = price - self.last_price
+            average_gain = self.gain.update(max(diff, 0.0))
+            average_loss = self.loss.update(abs(min(diff, 0.0)))
+            if average_loss == 0:
+                rs_emv = float('inf') if average_gain > 0 else float('nan')
+            else:
+                rs_emv = abs(average_gain / average_loss)
+            self.value = 100.0 - 100.0 / (1.0 + rs_emv)
+        self.last_price = price
+        return self.value
+
+
+class StreamingWilliamsR(object):
+    def __init__(self, window):
+        """
+        Streaming batch_williamsR, rolling max/min are kept in monotonic deques of (bar, price)
+        update(price) returns the Williams %R of the newest bar (NaN for the first window - 1 bars)
+        """
+        self.window = window
+        self.first_price = None
+        self.bars = 0
+        self.max_deque = deque()
+        self.min_deque = deque()
+        self.value = float('nan')
+
+    def update(self, price):
+        if self.first_price is None:
+            self.first_price = price
+        price = price / self.first_price
+        bar = self.bars
+        self.bars += 1
+
+        while self.max_deque and self.max_deque[-1][1] <= price:
+            self.max_deque.pop()
+        self.max_deque.append((bar, price))
+        while self.min_deque and self.min_deque[-1][1] >= price:
+            self.min_deque.pop()
+        self.min_deque.append((bar, price))
+
+        # Drop the bars that left the window
+        if self.max_deque[0][0] <= bar - self.window:
+            self.max_deque.popleft()
+        if self.min_deque[0][0] <= bar - self.window:
+            self.min_deque.popleft()
+
+        if self.bars < self.window:
+            self.value = float('nan')
+            return self.value
+
+        highest, lowest = self.max_deque[0][1], self.min_deque[0][1]
+        self.value = 100.0 * (price - highest) / (highest - lowest) if highest != lowest else float('nan')
+        return self.value
+
+
+class StreamingMomentum(object):
+    def __init__(self, window):
+        """
+        Streaming batch_momentum, which compares a bar with the bar window days later
+        A new price completes the momentum of the bar window days back, that is what update(price) returns
+        (NaN until window + 1 prices were seen), the newer bars are NaN in the batch version as well
+        """
+        self.window = window
+        self.prices = deque(maxlen=window + 1)
+        self.value = float('nan')
+
+    def update(self, price):
+        self.prices.append(price)
+        if len(self.prices) > self.window:
+            self.value = (self.prices[0] / price) - 1
+        return self.value
+
+
+class StreamingTRIX(object):
+    def __init__(self, window):
+        """
+        Streaming batch_TRIX, three chained ewm states over the normalized price
+        update(price) returns the TRIX of the newest bar (NaN on the first one)
+        """
+        self.ex1 = _StreamingEWM(window, min_periods=1)
+        self.ex2 = _StreamingEWM(window, min_periods=1)
+        self.ex3 = _StreamingEWM(window, min_periods=1)
+        self.first_price = None
+        self.last_ex3 = None
+        self.value = float('nan')
+
+    def update(self, price):
+        if self.first_price is None:
+            self.first_price = price
+        ex3 = self.ex3.update(self.ex2.update(self.ex1.update(price / self.first_price)))
+        if self.last_ex3 is not None:
+            self.value = 10000 * ((ex3 - self.last_ex3) / ex3)
+        self.last_ex3 = ex3
+        return self.value
+
+
+STREAMING_INDICATORS = {
+    'momentum': StreamingMomentum,
+    'rsi': StreamingRSI_EMV,
+    'trix': StreamingTRIX,
+    'williamsR': StreamingWilliamsR,
+}
+
+
+BATCH_INDICATORS = {
+    'sma': batch_SMA,
+    'momentum': batch_momentum,
+    'rsi': batch_RSI_EMV,
+    'trix': batch_TRIX,
+    'williamsR': batch_williamsR,
+}
+
+
 def run_indicators(symbols="JPM", sd="2008-01-01", ed="2009-12-31", save_fig=True):
     if not isinstance(symbols, list):
         symbols = [symbols]
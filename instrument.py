@@ -0,0 +1,179 @@
+"""
+Instrumentation of the hot paths: per stage call counts, time, rows processed and peak memory
+Enable it for a whole run with the INSTRUMENT environment variable (INSTRUMENT=1 for timers,
+INSTRUMENT=memory to also trace peak memory), or for a block of code with the instrumented() context manager
+When it is off, an instrumented function costs one flag check per call
+Only the calling process is measured, work done in process pool workers is not reported
+"""
+import functools
+import inspect
+import os
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+
+ENABLED = bool(os.environ.get("INSTRUMENT"))
+TRACE_MEMORY = os.environ.get("INSTRUMENT") == "memory"
+
+# Stage -> [calls, seconds, rows, peak bytes]
+_stats = OrderedDict()
+_lock = threading.Lock()
+_frames = threading.local()
+# Highest traced memory seen by any stage, tracemalloc's own peak is reset by every stage
+_traced_peak = 0
+
+if ENABLED and TRACE_MEMORY:
+    tracemalloc.start()
+
+
+def author():
+    return 'narora62'
+
+
+def timed(stage, rows=None):
+    """
+    Decorator that records the calls of a function under stage while instrumentation is enabled
+    :param stage: Name of the stage in the report, e.g. "RTLearner.query"
+    :param rows: Optional function (arguments, result) -> number of rows the call processed,
+        arguments maps every parameter name of the function to its value (see rows_of_arg)
+    """
+    def decorate(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+
+            memory = TRACE_MEMORY and tracemalloc.is_tracing()
+            if memory:
+                _enter_memory()
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                peak = _exit_memory() if memory else 0
+            record(stage, seconds, _count_rows(rows, signature, args, kwargs, result), peak)
+            return result
+        return wrapper
+    return decorate
+
+
+def _count_rows(rows, signature, args, kwargs, result):
+    # A row count that can't be worked out is dropped, instrumentation never changes what a call does
+    if rows is None:
+        return 0
+    try:
+        return rows(signature.bind(*args, **kwargs).arguments, result)
+    except Exception:
+        return 0
+
+
+def record(stage, seconds, rows=0, peak=0):
+    with _lock:
+        stats = _stats.setdefault(stage, [0, 0.0, 0, 0])
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] += rows
+        stats[3] = max(stats[3], peak)
+
+
+def _enter_memory():
+    # Nested stages share the tracemalloc peak, every frame keeps the highest peak seen before a child reset it
+    stack = getattr(_frames, 'stack', None)
+    if stack is None:
+        stack = _frames.stack = []
+    current, peak = tracemalloc.get_traced_memory()
+    if stack:
+        stack[-1][1] = max(stack[-1][1], peak)
+    tracemalloc.reset_peak()
+    stack.append([current, current])
+
+
+def _exit_memory():
+    global _traced_peak
+    stack = _frames.stack
+    start, peak_seen = stack.pop()
+    peak = max(peak_seen, tracemalloc.get_traced_memory()[1])
+    if stack:
+        stack[-1][1] = max(stack[-1][1], peak)
+    _traced_peak = max(_traced_peak, peak)
+    return peak - start
+
+
+@contextmanager
+def instrumented(memory=False, report_at_exit=False):
+    """
+    Enable instrumentation inside the with block
+    :param memory: Also trace the peak memory of every stage (tracemalloc, slows allocations down)
+    :param report_at_exit: Print the report when the block ends
+    """
+    global ENABLED, TRACE_MEMORY
+    previous = ENABLED, TRACE_MEMORY
+    started = memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    ENABLED, TRACE_MEMORY = True, memory or TRACE_MEMORY
+    try:
+        yield
+    finally:
+        ENABLED, TRACE_MEMORY = previous
+        if report_at_exit:
+            report()
+        if started:
+            tracemalloc.stop()
+
+
+def stats():
+    """
+    :return: dict stage -> {'calls', 'seconds', 'rows', 'peak_bytes'}
+    """
+    with _lock:
+        return {stage: dict(zip(('calls', 'seconds', 'rows', 'peak_bytes'), values)) for stage, values in _stats.items()}
+
+
+def add_rows(stage, rows):
+    """
+    Count rows for a stage from inside the function, for stages whose inputs are loaded by the function itself
+    """
+    if ENABLED:
+        with _lock:
+            _stats.setdefault(stage, [0, 0.0, 0, 0])[2] += rows
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+
+def report():
+    """
+    Print the per stage report, stages are nested so their times overlap
+    """
+    print(f"{'Stage':<32} {'Calls':>8} {'Total s':>10} {'Mean ms':>10} {'Rows':>12} {'Rows/s':>12} {'Peak MB':>9}")
+    for stage, values in sorted(stats().items(), key=lambda item: -item[1]['seconds']):
+        calls, seconds, rows, peak = values['calls'], values['seconds'], values['rows'], values['peak_bytes']
+        rate = f"{rows / seconds:12.0f}" if rows and seconds else f"{'':>12}"
+        peak = f"{peak / 1e6:9.1f}" if peak else f"{'':>9}"
+        print(f"{stage:<32} {calls:>8} {seconds:>10.3f} {seconds / calls * 1000:>10.3f} {rows:>12} {rate} {peak}")
+    if tracemalloc.is_tracing():
+        print(f"Traced peak memory: {max(_traced_peak, tracemalloc.get_traced_memory()[1]) / 1e6:.1f} MB")
+    try:
+        import resource
+        print(f"Process max RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+    except ImportError:
+        pass
+
+
+def rows_of_result(arguments, result):
+    return len(result)
+
+
+def rows_of_arg(name):
+    """
+    :return: Row counter of the parameter name, whether it was passed by position or by keyword
+    """
+    return lambda arguments, result: len(arguments[name])
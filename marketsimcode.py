@@ -1,97 +1,183 @@
+import csv
+
 import numpy as np
 import pandas as pd
 
-from util import get_data
+from instrument import timed, rows_of_result
+from util import align_history, get_data, get_history
 
 
 def author():
     return "narora62"
 
 
-def compute_portvals(orders="./orders/orders.csv", start_val=1000000, commission=9.95, impact=0.005):
+@timed("compute_portvals", rows=rows_of_result)
+def compute_portvals(orders="./orders/orders.csv", start_val=1000000, commission=9.95, impact=0.005, prices=None, symbol='JPM'):
+    """
+    :param prices: Optional Adj Close prices (dates x symbols, with SPY) already loaded by the caller,
+        used instead of reading the traded symbols again
+    :param symbol: Symbol traded by a trades frame without a 'Symbol' column (e.g. testPolicy output)
+    """
     # Keep legacy functionality
     if not isinstance(orders, pd.DataFrame):
         # Read the orders file and create a dataframe
         orders_df = pd.read_csv(orders, index_col="Date", parse_dates=True, na_values=["nan"])
     else:
         # Instead create orders
-        orders_df = create_orders(orders)
+        orders_df = create_orders(orders, symbol)
 
     # Start and end date is continuous datetime range
     start_date = min(orders_df.index)
     end_date = max(orders_df.index)
 
     # Set of ticker symbols traded within the order df
-    symbols = set(orders_df['Symbol'])
+    symbols = list(set(orders_df['Symbol']))
 
     # Create a df of all the above symbols containing their price chart
-    portvals = get_data(symbols, pd.date_range(start_date, end_date))
-
-    # Create cash flow column in above price chart df
-    # This cash val will be used to show the overall portfolio val
-    # i.e. For a specific date: Cash + (# of shares * share val) = Portfolio val
-    # If we add commission and impact, the portfolio value goes further down when BUY
-    # And when SELL happens, commission and impact lowers the portfolio value again
-    portvals['Cash'] = pd.Series(start_val, index=portvals.index)
-
-    # Keep track of number of shares
-    for symbol in symbols:
-        portvals[f"{symbol} Shares"] = pd.Series(0, index=portvals.index)
-
-    for date, transaction in orders_df.iterrows():
-        # For that date and symbol, get the closing share val
-        share_price = portvals.loc[date, transaction['Symbol']]
-
-        # Get the number of shares for that specific transaction
-        no_of_shares = int(transaction['Shares'])
-
-        if transaction['Order'] == "BUY":
-            # Add number of shares bought in the respective <Symbol> + Share column
-            portvals.loc[date:, f"{transaction['Symbol']} Shares"] += no_of_shares
-
-            # Immediately reduce the cash val including commission and impact
-            portvals.loc[date:, "Cash"] -= ((share_price * no_of_shares * (1 + impact)) + commission)
-
-        elif transaction['Order'] == "SELL":
-            # Reduce the number of shares for that symbol, can take negative vals
-            portvals.loc[date:, f"{transaction['Symbol']} Shares"] -= no_of_shares
-
-            # For that days share price, add the cash val to existing cash at hand
-            portvals.loc[date:, "Cash"] += ((share_price * no_of_shares * (1 - impact)) - commission)
+    if prices is None:
+        prices = get_data(symbols, pd.date_range(start_date, end_date))
+    else:
+        prices = prices.loc[start_date:end_date].dropna(subset=["SPY"])
+    price_matrix = prices[symbols].to_numpy(dtype=float)
+
+    # Map every order to its (trading day, symbol) cell of the price matrix
+    day_idx = prices.index.get_indexer(orders_df.index)
+    if (day_idx < 0).any():
+        raise KeyError(f"Orders placed on non trading days: {list(orders_df.index[day_idx < 0])}")
+    sym_idx = pd.Index(symbols).get_indexer(orders_df['Symbol'])
+
+    # For that date and symbol, get the closing share val
+    share_price = price_matrix[day_idx, sym_idx]
+    no_of_shares = orders_df['Shares'].to_numpy().astype(int)
+    is_buy = (orders_df['Order'] == "BUY").to_numpy()
+    is_sell = (orders_df['Order'] == "SELL").to_numpy()
+
+    # BUY adds shares and immediately reduces the cash val including commission and impact
+    # SELL reduces shares (can go negative) and adds the cash val minus commission and impact
+    shares_traded = np.where(is_buy, no_of_shares, np.where(is_sell, -no_of_shares, 0))
+    cash_flow = np.where(is_buy, -((share_price * no_of_shares * (1 + impact)) + commission),
+                         np.where(is_sell, (share_price * no_of_shares * (1 - impact)) - commission, 0.0))
+
+    # Trades matrix (days x symbols) and daily cash flow, several orders can land on the same day
+    trades = np.zeros(price_matrix.shape)
+    np.add.at(trades, (day_idx, sym_idx), shares_traded)
+    daily_cash = np.zeros(price_matrix.shape[0])
+    np.add.at(daily_cash, day_idx, cash_flow)
+
+    # Holdings and cash at hand are the running totals of the trades
+    holdings = trades.cumsum(axis=0)
+    cash = start_val + daily_cash.cumsum()
 
     # To compute portfolio value for each valid trading day
     # Here, the portfolio value is described as:
     # Cash at hand + (# of shares * share price)
     # Cash at hand has already paid the commission and impact, so that is included already
-    for date, transaction in portvals.iterrows():
-        symbol_value = 0
-        # Multiple ticker symbols can be traded in 1 day, so we need to account for that
-        for symbol in symbols:
-            # Get the ticker value for that date
-            symbol_value += portvals.loc[date, f"{symbol} Shares"] * transaction[symbol]
-            # Add it to cash at hand
-            portvals.loc[date, 'portval'] = portvals.loc[date, 'Cash'] + symbol_value
+    portval = cash + (holdings * price_matrix).sum(axis=1)
 
     # Return the portval column
-    return portvals.loc[:, ['portval']]
+    return pd.DataFrame({'portval': portval}, index=prices.index)
+
+
+def read_orders(orders="./orders/orders.csv"):
+    """
+    Stream an orders csv (Date, Symbol, Order, Shares) one row at a time
+    :return: Generator of (date, symbol, order, shares)
+    """
+    with open(orders, newline='') as f:
+        for row in csv.DictReader(f):
+            yield pd.Timestamp(row['Date']), row['Symbol'], row['Order'], int(float(row['Shares']))
+
+
+def stream_portvals(orders, start_val=1000000, commission=9.95, impact=0.005, end_date=None):
+    """
+    Event-driven compute_portvals, orders are consumed as they come and only holdings and cash are kept
+    :param orders: Iterable of (date, symbol, order, shares) sorted by date, e.g. read_orders(path), a generator,
+        or iter(queue.get, None) for a queue
+    :param end_date: Keep emitting values until this date, by default the stream ends on the last order date
+    :return: Generator of (date, portval) for every trading day (SPY calendar) from the first order on
+    """
+    orders = iter(orders)
+    order = next(orders, None)
+    if order is None:
+        return
+
+    spy = get_history("SPY")
+    calendar = spy.index[spy.notna().to_numpy()]
+    day = calendar.searchsorted(order[0])
+    end_day = len(calendar) if end_date is None else calendar.searchsorted(pd.Timestamp(end_date), side='right')
+
+    # Prices of a symbol are aligned to the calendar the first time it is traded
+    prices = {}
+    holdings = {}
+    cash = float(start_val)
+    last_date = None
+    while day < end_day:
+        date = calendar[day]
+        while order is not None and order[0] <= date:
+            order_date, symbol, side, shares = order
+            if last_date is not None and order_date < last_date:
+                raise ValueError(f"Orders are not sorted by date: {order_date} after {last_date}")
+            if order_date != date:
+                raise KeyError(f"Order placed on a non trading day: {order_date}")
+            last_date = order_date
+
+            if symbol not in prices:
+                prices[symbol] = align_history(get_history(symbol), calendar)
+                holdings[symbol] = 0
+            share_price = prices[symbol][day]
+            if side == "BUY":
+                holdings[symbol] += shares
+                cash -= (share_price * shares * (1 + impact)) + commission
+            elif side == "SELL":
+                holdings[symbol] -= shares
+                cash += (share_price * shares * (1 - impact)) - commission
+            order = next(orders, None)
+
+        yield date, cash + sum(shares * prices[symbol][day] for symbol, shares in holdings.items())
+        if order is None and end_date is None:
+            return
+        day += 1
+
+
+def create_orders(orders_df, symbol='JPM'):
+    """
+    Turn a trades frame (signed 'shares' per date) into orders
+    Frames with a 'Symbol' column (multi symbol trades) keep it, otherwise every trade is for symbol
+    """
+    orders_df.dropna(subset=['shares'], inplace=True)
+    if 'Symbol' not in orders_df.columns:
+        orders_df['Symbol'] = pd.Series(symbol, index=orders_df.index)
 
+    # A row with 0 shares repeats the previous order of its symbol, as every order used to be written forward in time
+    shares = orders_df['shares']
+    orders_df['Order'] = pd.Series(np.where(shares > 0, "BUY", np.where(shares < 0, "SELL", None)), index=orders_df.index)
+    orders_df['Shares'] = shares.abs().where(shares != 0)
+    orders_df[['Order', 'Shares']] = orders_df.groupby('Symbol')[['Order', 'Shares']].ffill().fillna(0).to_numpy()
 
-def create_orders(orders_df):
-    orders_df.dropna(subset=['shares'], inplace=True)
-    orders_df['Symbol'] = pd.Series('JPM', index=orders_df.index)
-    orders_df['Order'] = pd.Series(0, index=orders_df.index)
-    orders_df['Shares'] = pd.Series(0, index=orders_df.index)
+    return orders_df
 
-    for date, _ in orders_df.iterrows():
-        if orders_df.loc[date, 'shares'] > 0:
-            orders_df.loc[date:, 'Order'] = "BUY"
-            orders_df.loc[date:, 'Shares'] = orders_df.loc[date, 'shares']
 
-        elif orders_df.loc[date, 'shares'] < 0:
-            orders_df.loc[date:, 'Order'] = "SELL"
-            orders_df.loc[date:, 'Shares'] = -orders_df.loc[date, 'shares']
+def signals_to_trades(buy, sell, shares=1000):
+    """
+    Net holdings are limited to -shares, 0 and +shares: a BUY signal goes (or stays) long, a SELL signal
+    goes (or stays) short and any other day holds. The holdings are a forward fill of the signals and
+    the trades are their diff, so no per-day state loop is needed
+    :param buy: bool array, BUY signal per day (wins if both signals are set)
+    :param sell: bool array, SELL signal per day
+    :return: trades (NaN on days without a trade), final net holdings
+    """
+    signal = np.select([buy, sell], [shares, -shares], 0)
+    days = np.flatnonzero(signal)
+    if not days.size:
+        return np.full(signal.shape, np.nan), 0
 
-    return orders_df
+    # Forward fill the last signal, days before the first signal are flat
+    last_signal_day = np.maximum.accumulate(np.where(signal != 0, np.arange(signal.size), 0))
+    holdings = np.where(np.arange(signal.size) < days[0], 0, signal[last_signal_day]).astype(float)
+
+    trades = np.diff(holdings, prepend=0.0)
+    trades[trades == 0] = np.nan
+    return trades, int(holdings[-1])
 
 
 def compute_optimized_portfolio_stats(port_val, rfr=0.0, sf=252.0):
@@ -104,6 +190,57 @@ def compute_optimized_portfolio_stats(port_val, rfr=0.0, sf=252.0):
     return cr, adr, sddr, sr
 
 
+def batch_portfolio_stats(port_vals, traded=None, rfr=0.0, sf=252.0):
+    """
+    compute_optimized_portfolio_stats for many equity curves in one numpy pass
+    Columns can be ragged (NaN before the first and after the last value), every column is scored on its own values
+    :param port_vals: days x strategies portfolio values (DataFrame or 2-D array)
+    :param traded: days x strategies absolute traded value, turnover is its sum over the mean portfolio value
+    :return: DataFrame with one row per strategy: cum_ret, avg_daily_ret, std_daily_ret, sharpe_ratio, max_drawdown,
+        sortino_ratio, turnover (NaN without traded)
+    """
+    index = port_vals.columns if isinstance(port_vals, pd.DataFrame) else None
+    values = np.asarray(port_vals, dtype=np.float64)
+    if values.ndim == 1:
+        values = values[:, None]
+    valid = ~np.isnan(values)
+    days = np.arange(len(values))[:, None]
+
+    # Get the first and the last value of every column
+    first = np.where(valid, days, len(values)).min(axis=0)
+    last = np.where(valid, days, -1).max(axis=0)
+    columns = np.arange(values.shape[1])
+    cr = values[np.minimum(first, len(values) - 1), columns]
+    cr = values[np.maximum(last, 0), columns] / cr - 1
+
+    daily_return = np.full_like(values, np.nan)
+    daily_return[1:] = values[1:] / values[:-1] - 1
+    counts = np.count_nonzero(~np.isnan(daily_return), axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        adr = np.nansum(daily_return, axis=0) / counts
+        sddr = np.sqrt(np.nansum((daily_return - adr) ** 2, axis=0) / (counts - 1))
+        excess = daily_return - rfr
+        sr = np.sqrt(sf) * np.nansum(excess, axis=0) / counts / sddr
+        downside = np.sqrt(np.nansum(np.minimum(excess, 0) ** 2, axis=0) / counts)
+        sortino = np.sqrt(sf) * np.nansum(excess, axis=0) / counts / downside
+        # Series.std() is NaN below two returns, the ratios built on it are too
+        sddr[counts < 2] = sr[counts < 2] = sortino[counts < 2] = np.nan
+
+        # Drawdown from the running peak, NaN days don't move the peak
+        peak = np.fmax.accumulate(values, axis=0)
+        max_drawdown = np.nanmin(np.where(valid, values / peak - 1, np.inf), axis=0)
+        max_drawdown[first == len(values)] = np.nan
+
+        if traded is None:
+            turnover = np.full(values.shape[1], np.nan)
+        else:
+            traded = np.abs(np.asarray(traded, dtype=np.float64).reshape(values.shape))
+            turnover = np.nansum(traded, axis=0) / (np.nansum(values, axis=0) / valid.sum(axis=0))
+
+    return pd.DataFrame({'cum_ret': cr, 'avg_daily_ret': adr, 'std_daily_ret': sddr, 'sharpe_ratio': sr,
+                         'max_drawdown': max_drawdown, 'sortino_ratio': sortino, 'turnover': turnover}, index=index)
+
+
 def compute_portfolio(allocs, prices, sv=1):
     prices_normalized = prices / prices.iloc[0]
     pos_vals = prices_normalized * allocs * sv
@@ -1,5 +1,6 @@
 import datetime as dt
 
+import instrument
 from ManualStrategy import run_manual_strategy
 from ManualStrategy import testPolicy as testPolicy_ms
 from StrategyLearner import StrategyLearner
@@ -49,6 +50,12 @@ def main():
     experiment2(save_fig=save_fig, fig_name='Experiment2.png')
     print(hr)
 
+    if instrument.ENABLED:
+        # INSTRUMENT=1 python testproject.py
+        print("Instrumentation report...\n")
+        instrument.report()
+        print(hr)
+
 
 if __name__ == '__main__':
     main()
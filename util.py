@@ -1,7 +1,18 @@
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import pandas as pd
 
+from instrument import timed, rows_of_result
+
+STORE_COLUMNS = ("Open", "High", "Low", "Close", "Volume", "Adj Close")
+
+# Open price stores, keyed by absolute store directory
+_price_stores = {}
+
 
 def symbol_to_path(symbol, base_dir=None):
     if base_dir is None:
@@ -10,21 +21,320 @@ def symbol_to_path(symbol, base_dir=None):
 
 
 def get_data(symbols, dates, addSPY=True, colname="Adj Close"):
+    return get_data_columns(symbols, dates, addSPY=addSPY, colnames=[colname])[colname]
+
+
+@timed("util.get_data", rows=lambda arguments, result: len(next(iter(result.values()))))
+def get_data_columns(symbols, dates, addSPY=True, colnames=STORE_COLUMNS):
+    """
+    Load several columns (e.g. High, Low, Close, Volume) with one parse per csv file
+    :return: dict colname -> DataFrame (dates x symbols), all frames share the same index
+    """
     df = pd.DataFrame(index=dates)
     if addSPY and "SPY" not in symbols:
         symbols = ["SPY"] + list(symbols)
 
-    for symbol in symbols:
-        df_temp = pd.read_csv(symbol_to_path(symbol), index_col="Date", parse_dates=True, usecols=["Date", colname], na_values=["nan"])
-        df_temp = df_temp.rename(columns={colname: symbol})
-        df = df.join(df_temp)
-        if symbol == "SPY":
-            df = df.dropna(subset=["SPY"])
+    # Full histories come from the cache (or the store/csv on a miss), the date range is a slice of them
+    requested = _dates_i8(df.index)
+    values = {colname: np.empty((len(df.index), len(symbols))) for colname in colnames}
+    for column, symbol in enumerate(symbols):
+        histories = get_histories(symbol, colnames)
+        for colname in colnames:
+            values[colname][:, column] = _align(histories[colname], requested)
+    frames = {colname: pd.DataFrame(values[colname], index=df.index, columns=list(symbols)) for colname in colnames}
+
+    # Keep the days SPY traded, whichever columns were asked for
+    if "SPY" in symbols:
+        traded = np.zeros(len(df.index), dtype=bool)
+        for colname in colnames:
+            traded |= frames[colname]["SPY"].notna().to_numpy()
+        frames = {colname: frame[traded] for colname, frame in frames.items()}
+    return frames
+
+
+def get_symbol_list(list_name, base_dir=None):
+    """
+    Symbols of a universe list in <base_dir>/Lists, e.g. "sp5002012" or "sp5002012.txt"
+    """
+    if base_dir is None:
+        base_dir = os.environ.get("MARKET_DATA_DIR", "data/")
+    if not list_name.endswith(".txt"):
+        list_name = "{}.txt".format(list_name)
+    with open(os.path.join(base_dir, "Lists", list_name)) as f:
+        return f.read().split()
+
+
+def get_universe(list_name, dates, addSPY=True, colname="Adj Close", n_jobs=16):
+    """
+    Load every symbol of a universe list, files are read concurrently by a thread pool
+    The result is aligned to the SPY trading calendar and built as one matrix at the end
+    :param addSPY: Keep the SPY column in the result, SPY is always used for the calendar
+    """
+    symbols = get_symbol_list(list_name)
+    if "SPY" not in symbols:
+        symbols = ["SPY"] + symbols
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        histories = list(pool.map(lambda symbol: get_history(symbol, colname), symbols))
+
+    index = pd.DataFrame(index=dates).index
+    requested = _dates_i8(index)
+    values = np.empty((len(index), len(symbols)))
+    for column, history in enumerate(histories):
+        values[:, column] = _align(history, requested)
+    df = pd.DataFrame(values, index=index, columns=symbols)
+
+    df = df.dropna(subset=["SPY"])
+    if not addSPY:
+        df = df.drop(columns=["SPY"])
     return df
 
 
-def plot_data(df, title="Stock prices", xlabel="Date", ylabel="Price", legend=True):
+def get_history(symbol, colname="Adj Close"):
+    """
+    Full history of one column for one symbol, read once per process through price_cache
+    Callers must not modify the returned Series in place
+    """
+    return get_histories(symbol, [colname])[colname]
+
+
+def get_histories(symbol, colnames):
+    """
+    Full histories of several columns for one symbol, missing columns are read with a single csv parse
+    :return: dict colname -> Series
+    """
+    histories = {colname: price_cache.get((symbol, colname)) for colname in colnames}
+    missing = [colname for colname, history in histories.items() if history is None]
+
+    store = load_price_store()
+    if store is not None:
+        for colname in [colname for colname in missing if store.has(symbol, colname)]:
+            histories[colname] = store.history(symbol, colname)
+            price_cache.put((symbol, colname), histories[colname])
+            missing.remove(colname)
+
+    if missing:
+        df_temp = _read_csv(symbol, missing)
+        for colname in missing:
+            histories[colname] = df_temp[colname].rename(symbol)
+            price_cache.put((symbol, colname), histories[colname])
+    return histories
+
+
+@timed("util.read_csv", rows=rows_of_result)
+def _read_csv(symbol, colnames):
+    df_temp = pd.read_csv(symbol_to_path(symbol), index_col="Date", parse_dates=True, usecols=["Date"] + colnames, na_values=["nan"])
+    return df_temp.sort_index()
+
+
+def _dates_i8(index):
+    return index.values.astype("datetime64[ns]", copy=False).view("i8")
+
+
+def _align(history, requested):
+    # Histories are sorted by date, so a searchsorted is a vectorized left join onto the requested dates
+    history_i8 = _dates_i8(history.index)
+    if not len(history_i8):
+        return np.full(len(requested), np.nan)
+    positions = np.minimum(np.searchsorted(history_i8, requested), len(history_i8) - 1)
+    found = history_i8[positions] == requested
+    return np.where(found, history.to_numpy(dtype=np.float64)[positions], np.nan)
+
+
+def align_history(history, index):
+    """
+    Values of a date sorted history on the dates of index, e.g. a full get_history aligned to a trading calendar
+    :return: float64 array with one value per date of index, NaN where the history has no value
+    """
+    return _align(history, _dates_i8(pd.DatetimeIndex(index)))
+
+
+class HistoryCache(object):
+    def __init__(self, max_entries=512, max_bytes=256 * 1024 * 1024):
+        """
+        LRU cache of full price histories keyed by (symbol, column)
+        Evicts the least recently used entries once either limit is exceeded, 0 entries disables it
+        :param max_entries:
+        :param max_bytes:
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        # Loaders like get_universe fill the cache from several threads
+        self.lock = threading.RLock()
+
+    def get(self, key):
+        with self.lock:
+            history = self.entries.get(key)
+            if history is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return history
+
+    def put(self, key, history):
+        size = history.memory_usage(index=True)
+        with self.lock:
+            if key in self.entries or size > self.max_bytes or self.max_entries <= 0:
+                return
+            self.entries[key] = history
+            self.nbytes += size
+            self.evict()
+
+    def resize(self, max_entries=None, max_bytes=None):
+        with self.lock:
+            if max_entries is not None:
+                self.max_entries = max_entries
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            self.evict()
+
+    def evict(self):
+        with self.lock:
+            while self.entries and (len(self.entries) > self.max_entries or self.nbytes > self.max_bytes):
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= evicted.memory_usage(index=True)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "bytes": self.nbytes}
+
+
+price_cache = HistoryCache(max_entries=int(os.environ.get("MARKET_CACHE_ENTRIES", 512)), max_bytes=int(os.environ.get("MARKET_CACHE_BYTES", 256 * 1024 * 1024)))
+
+
+def store_dir_path(base_dir=None):
+    if base_dir is None:
+        base_dir = os.environ.get("MARKET_DATA_DIR", "data/")
+    return os.environ.get("MARKET_STORE_DIR", os.path.join(base_dir, "store"))
+
+
+def _store_column_path(store_dir, colname):
+    return os.path.join(store_dir, "{}.npy".format(colname.replace(" ", "_")))
+
+
+def _csv_stat(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def build_price_store(base_dir=None, store_dir=None, columns=STORE_COLUMNS):
+    """
+    One time conversion of <base_dir>/*.csv into a binary columnar store:
+        dates.npy     -> shared datetime64 date axis (union of all trading days)
+        <column>.npy  -> float64 matrix (symbols x dates) per column, NaN where a symbol has no row
+        csv_stats.npy -> (mtime_ns, size) of every csv, a symbol whose csv changed since is read from the csv
+        symbols.txt   -> row order of the matrices, written last so a partial build is never read
+    Rows are per symbol so reading a few symbols from the memory map touches contiguous pages only
+    """
+    if base_dir is None:
+        base_dir = os.environ.get("MARKET_DATA_DIR", "data/")
+    if store_dir is None:
+        store_dir = store_dir_path(base_dir)
+    os.makedirs(store_dir, exist_ok=True)
+
+    symbols = sorted(os.path.splitext(name)[0] for name in os.listdir(base_dir) if name.endswith(".csv"))
+    frames = [pd.read_csv(symbol_to_path(symbol, base_dir), index_col="Date", parse_dates=True, usecols=["Date"] + list(columns), na_values=["nan"]) for symbol in symbols]
+
+    dates = frames[0].index
+    for frame in frames[1:]:
+        dates = dates.union(frame.index)
+    dates = dates.sort_values()
+    np.save(os.path.join(store_dir, "dates.npy"), dates.values.astype("datetime64[ns]"))
+
+    for colname in columns:
+        matrix = np.lib.format.open_memmap(_store_column_path(store_dir, colname), mode="w+", dtype=np.float64, shape=(len(symbols), len(dates)))
+        for row, frame in enumerate(frames):
+            matrix[row] = np.nan
+            matrix[row, dates.get_indexer(frame.index)] = frame[colname].to_numpy(dtype=np.float64)
+        matrix.flush()
+        del matrix
+
+    np.save(os.path.join(store_dir, "csv_stats.npy"), np.array([_csv_stat(symbol_to_path(symbol, base_dir)) for symbol in symbols], dtype=np.int64))
+    with open(os.path.join(store_dir, "symbols.txt"), "w") as f:
+        f.write("\n".join(symbols))
+    _price_stores.pop(os.path.abspath(store_dir), None)
+
+
+class PriceStore(object):
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.dates = pd.DatetimeIndex(np.load(os.path.join(store_dir, "dates.npy")))
+        with open(os.path.join(store_dir, "symbols.txt")) as f:
+            self.rows = {symbol: row for row, symbol in enumerate(f.read().split())}
+        self.columns = {}
+        # (mtime_ns, size) of every csv when the store was built, a store without them is never trusted
+        path = os.path.join(store_dir, "csv_stats.npy")
+        self.csv_stats = np.load(path) if os.path.exists(path) else None
+        self.fresh = {}
+
+    def column(self, colname):
+        # Memory map each column matrix once, pages are only read when touched
+        if colname not in self.columns:
+            path = _store_column_path(self.store_dir, colname)
+            self.columns[colname] = np.load(path, mmap_mode="r") if os.path.exists(path) else None
+        return self.columns[colname]
+
+    def has(self, symbol, colname):
+        return symbol in self.rows and self.is_fresh(symbol) and self.column(colname) is not None
+
+    def is_fresh(self, symbol):
+        """
+        False once the csv of the symbol was edited or replaced after the build, get_data then reads the csv
+        """
+        if symbol not in self.fresh:
+            # Without its csv the store is the only copy of a symbol
+            current = _csv_stat(symbol_to_path(symbol))
+            self.fresh[symbol] = self.csv_stats is not None and (current is None or tuple(self.csv_stats[self.rows[symbol]]) == current)
+        return self.fresh[symbol]
+
+    def history(self, symbol, colname):
+        """
+        :return: Series of colname over the dates the symbol has a value for
+        """
+        history = pd.Series(np.array(self.column(colname)[self.rows[symbol]]), index=self.dates, name=symbol)
+        return history.dropna()
+
+
+def load_price_store(store_dir=None):
+    if store_dir is None:
+        store_dir = store_dir_path()
+    key = os.path.abspath(store_dir)
+    if key not in _price_stores:
+        if not os.path.exists(os.path.join(store_dir, "symbols.txt")):
+            return None
+        _price_stores[key] = PriceStore(store_dir)
+    return _price_stores[key]
+
+
+def get_pyplot():
+    """
+    pyplot is imported on first use, so importing the strategy modules never loads matplotlib
+    HEADLESS=1 in the environment selects the non interactive Agg backend for the whole run,
+    otherwise the backend is left alone so plt.show() keeps working
+    """
+    import matplotlib
+    if os.environ.get("HEADLESS"):
+        matplotlib.use("Agg")
     import matplotlib.pyplot as plt
+    return plt
+
+
+def plot_data(df, title="Stock prices", xlabel="Date", ylabel="Price", legend=True):
+    plt = get_pyplot()
     ax = df.plot(title=title, fontsize=12)
     ax.set_xlabel(xlabel)
     ax.set_ylabel(ylabel)
@@ -42,3 +352,7 @@ def get_learner_data_file(basefilename):
 def get_robot_world_file(basefilename):
     return open(os.path.join(os.environ.get("ROBOT_WORLDS_DIR", "testworlds/"), basefilename)
                 )
+
+
+if __name__ == "__main__":
+    build_price_store()
@@ -0,0 +1,118 @@
+"""
+Walk-forward validation of the StrategyLearner: train on a rolling window, trade the window that follows,
+move forward and repeat over the whole history. The out-of-sample signals of all folds are stitched into
+one trades frame and simulated as a single equity curve.
+"""
+import datetime as dt
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import util as ut
+from StrategyLearner import StrategyLearner, INDICATOR_WINDOWS
+from marketsimcode import compute_portvals, compute_optimized_portfolio_stats, signals_to_trades
+
+
+def author():
+    return "narora62"
+
+
+def make_folds(trading_days, train_days=504, test_days=126, step_days=None):
+    """
+    Rolling windows over trading days: train on train_days, test on the next test_days, then move forward
+    by step_days (defaults to test_days, so the test windows tile the history)
+    :return: list of (train_sd, train_ed, test_sd, test_ed)
+    """
+    step_days = step_days or test_days
+    folds = []
+    start = 0
+    while start + train_days + test_days <= len(trading_days):
+        train = trading_days[start:start + train_days]
+        test = trading_days[start + train_days:start + train_days + test_days]
+        folds.append((train[0], train[-1], test[0], test[-1]))
+        start += step_days
+    return folds
+
+
+def walk_forward(symbol="JPM", sd=dt.datetime(2001, 1, 1), ed=dt.datetime(2011, 12, 31), train_days=504, test_days=126, step_days=None,
+                 impact=0.005, commission=9.95, sv=100000, leaf_size=5, bags=15, n_jobs=None, seed=None, feature_cache=False):
+    """
+    Retrain a StrategyLearner per fold (folds run on a process pool) and trade its out-of-sample window
+    Holdings carry over fold boundaries, the position is closed on the last out-of-sample day
+    :param n_jobs: Number of worker processes, 1 runs the folds in this process
+    :param seed: Base seed, fold i is trained with np.random.seed(seed + i) for reproducible results
+    :param feature_cache: Keep the full history features in the on disk feature cache for reruns
+    :return: trades (shares per day), port_vals (portval per out-of-sample day), DataFrame of per fold results
+    """
+    prices = ut.get_data([symbol], pd.date_range(sd, ed))
+    folds = make_folds(prices.index, train_days, test_days, step_days)
+    if not folds:
+        raise ValueError(f"{sd} to {ed} is too short for {train_days} training and {test_days} test days")
+
+    # Indicators are computed once over the full history and every fold slices them, so overlapping windows
+    # share one computation and each window starts with its indicator warm up already done
+    features = causal_features(StrategyLearner(feature_cache=feature_cache).compute_indicators(prices[[symbol]].dropna()))
+
+    # Workers get their fold's features in the job, nothing relies on state inherited from this process
+    jobs = [(symbol, fold, features.loc[fold[0]:fold[1]], features.loc[fold[2]:fold[3]], impact, commission, leaf_size, bags, sv,
+             None if seed is None else seed + i) for i, fold in enumerate(folds)]
+    if n_jobs == 1:
+        signals = [_run_fold(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            signals = list(pool.map(_run_fold, jobs))
+
+    # Stitch the learner output of all folds, a later fold wins where test windows overlap
+    y_out = pd.concat(signals)
+    y_out = y_out[~y_out.index.duplicated(keep='last')]
+    out_of_sample = prices.loc[folds[0][2]:folds[-1][3]].index
+    y_out = y_out.reindex(out_of_sample).to_numpy()
+
+    # One position pass over the whole out-of-sample period, BUY above 0.5, SELL below 0, HOLD otherwise
+    shares, net_shares = signals_to_trades(y_out > 0.5, y_out < 0)
+    if net_shares != 0:
+        shares[-1] = np.nan_to_num(shares[-1]) - net_shares
+    trades = pd.DataFrame({'shares': shares}, index=out_of_sample).dropna()
+
+    if trades.empty:
+        port_vals = pd.DataFrame({'portval': float(sv)}, index=out_of_sample)
+    else:
+        port_vals = compute_portvals(orders=trades.copy(), start_val=sv, commission=commission, impact=impact, prices=prices, symbol=symbol)
+        port_vals = port_vals.reindex(out_of_sample).ffill().fillna(sv)
+
+    rows = []
+    for (train_sd, train_ed, test_sd, test_ed), signal in zip(folds, signals):
+        fold_vals = port_vals.loc[test_sd:test_ed, 'portval']
+        cum_ret, avg_daily_ret, std_daily_ret, sharpe_ratio = compute_optimized_portfolio_stats(fold_vals)
+        rows.append({'train_sd': train_sd, 'train_ed': train_ed, 'test_sd': test_sd, 'test_ed': test_ed,
+                     'trades': len(trades.loc[test_sd:test_ed]), 'cum_ret': cum_ret, 'sharpe_ratio': sharpe_ratio})
+    return trades, port_vals, pd.DataFrame(rows)
+
+
+def causal_features(features):
+    """
+    Features that only use prices up to their own day: momentum (p[t] / p[t + window] - 1) looks ahead,
+    it is lagged by its window to p[t - window] / p[t] - 1 for training and testing alike
+    """
+    features = features.copy()
+    features['momentum'] = features['momentum'].shift(INDICATOR_WINDOWS['momentum'])
+    return features
+
+
+def _run_fold(job):
+    symbol, (train_sd, train_ed, test_sd, test_ed), train_features, test_features, impact, commission, leaf_size, bags, sv, seed = job
+    if seed is not None:
+        np.random.seed(seed)
+
+    learner = StrategyLearner(verbose=False, impact=impact, commission=commission, leaf_size=leaf_size, bags=bags)
+    learner.add_evidence(symbol=symbol, sd=train_sd, ed=train_ed, sv=sv, features=train_features)  # training phase
+    return learner.predict(test_features)
+
+if __name__ == '__main__':
+    trades, port_vals, folds = walk_forward()
+    print(folds.to_string())
+    cum_ret, avg_daily_ret, std_daily_ret, sharpe_ratio = compute_optimized_portfolio_stats(port_vals['portval'])
+    print("Cumulative Return of Walk-Forward Strategy Learner: {}".format(cum_ret))
+    print("Sharpe Ratio of Walk-Forward Strategy Learner: {}".format(sharpe_ratio))
+    print("Final Portfolio Value: {}".format(port_vals['portval'][-1]))